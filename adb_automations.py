@@ -3,21 +3,35 @@ Module containing all automation of ADB interaction
 """
 
 import logging
-from ppadb.client import Client as AdbClient
-from ppadb.device import Device
+import os
+
+from async_adb import AdbEventLoop
+from image_store import DeviceImageCache, ImageStore
+from metrics import timed
+
+DEVICE_DOWNLOAD_FOLDER = '/storage/emulated/0/Download'
 
 
 class ADBAutomationHandler:
     """
-    A class to automate all interactions made over ADB
+    A class to automate all interactions made over ADB.
+    The methods are thin wrappers around the shared asyncio adb client,
+    so several handlers talk to their devices concurrently.
     """
 
-    def __init__(self, device_id=0):
-        adb = AdbClient(host='127.0.0.1', port=5037)
-        devices = adb.devices()
-        self.device: Device = devices[device_id]
-        logging.info("ADB is now connected to device %s",
-                     self.device.get_serial_no())
+    def __init__(self, device_id=0, serial=None, adb: AdbEventLoop = None):
+        self.adb = adb or AdbEventLoop.instance()
+        self.client = self.adb.client
+        devices = self.adb.run(self.client.devices())
+        if serial is not None:
+            if serial not in devices:
+                raise ValueError(f"ADB device {serial} is not connected")
+            self.serial = serial
+        else:
+            self.serial = devices[device_id]
+        self.image_store = ImageStore()
+        self.image_cache = DeviceImageCache(self.serial)
+        logging.info("ADB is now connected to device %s", self.serial)
 
     def get_device_id(self):
         """
@@ -26,40 +40,95 @@ class ADBAutomationHandler:
         Returns:
             str: The id of the device
         """
-        return self.device.get_serial_no()
+        return self.serial
 
-    def prepare_vm(self):
+    @timed('adb.shell', 'serial')
+    def shell(self, command: str):
+        """
+        Runs a shell command on the connected device
+
+        Returns:
+            str: The output of the command
+        """
+        return self.adb.run(self.client.shell(self.serial, command))
+
+    @timed('adb.push', 'serial')
+    def push(self, source: str, destination: str):
+        """
+        Pushes a file to the connected device
+        """
+        self.adb.run(self.client.push(self.serial, source, destination))
+
+    async def prepare_vm_async(self):
         """
         Prepares the device connected over adb, reinstalling postcardcreator and starting it
         """
 
         # Check if postcard creator is installed
-        serial_num = self.device.get_serial_no()
-        is_pcc_installed = self.device.is_installed('ch.post.it.pcc')
+        is_pcc_installed = await self.client.is_installed(self.serial, 'ch.post.it.pcc')
 
         if not is_pcc_installed:
-            self.device.install('./application/postcardcreator.apk')
+            await self.client.install(self.serial, './application/postcardcreator.apk')
 
-        logging.info('Postcardcreator is installed on device %s', serial_num)
+        logging.info('Postcardcreator is installed on device %s', self.serial)
 
-        self.device.shell('monkey -p ch.post.it.pcc 1')
+        await self.client.shell(self.serial, 'monkey -p ch.post.it.pcc 1')
 
-        logging.info('Postcardcreator is now opened on device %s', serial_num)
+        logging.info('Postcardcreator is now opened on device %s', self.serial)
 
         return True
 
-    def upload_image(self, image_name, clear_downloads_folder=True):
+    @timed('adb.prepare_vm', 'serial')
+    def prepare_vm(self):
+        """
+        Prepares the device connected over adb, reinstalling postcardcreator and starting it
+        """
+        return self.adb.run(self.prepare_vm_async())
+
+    def __is_image_on_device(self, image_name):
+        path = f'{DEVICE_DOWNLOAD_FOLDER}/{image_name}'
+        # Touching the file keeps the image on top of the recent files of the picker
+        output = self.shell(f'[ -f {path} ] && touch {path} && echo present')
+        return 'present' in (output or '')
+
+    @timed('adb.upload_image', 'serial')
+    def upload_image(self, image_name):
         """
-        Uploads the given image to the downloads folder of the connected device
-        Clears all files in downloads on the device if specified
+        Uploads the given image from the image store to the downloads folder of the connected device.
+        The image is only pushed if it is not on the device already,
+        the least recently used images are deleted from the device.
 
         Args:
-            image_name (_type_): _description_
+            image_name (str): The name of the image in the image store
+        """
+        if image_name in self.image_cache and self.__is_image_on_device(image_name):
+            logging.info('Image %s is already on the virtual device', image_name)
+        else:
+            self.push(self.image_store.path(image_name),
+                      f'{DEVICE_DOWNLOAD_FOLDER}/{image_name}')
+            logging.info('Uploaded image %s to the virtual device', image_name)
+
+        if evicted := self.image_cache.touch(image_name):
+            paths = ' '.join(f'{DEVICE_DOWNLOAD_FOLDER}/{name}' for name in evicted)
+            self.shell(f'rm -f {paths}')
+
+    @timed('adb.verify_image', 'serial')
+    def verify_image(self, image_name):
         """
-        if clear_downloads_folder:
-            self.device.shell('rm -r /storage/emulated/0/Download/*')
+        Checks that the image on the device is complete by comparing its size with the image store
 
-        self.device.push(f'images/{image_name}',
-                         f'/storage/emulated/0/Download/{image_name}')
+        Args:
+            image_name (str): The name of the image in the image store
 
-        logging.info('Uploaded image %s to the virtual device', image_name)
+        Returns:
+            bool: Whether the image on the device has the expected size
+        """
+        output = self.shell(
+            f'stat -c %s {DEVICE_DOWNLOAD_FOLDER}/{image_name} 2>/dev/null') or ''
+        expected_size = os.path.getsize(self.image_store.path(image_name))
+        if output.strip() == str(expected_size):
+            return True
+
+        logging.warning('Image %s on the device is incomplete or missing', image_name)
+        self.image_cache.discard(image_name)
+        return False
@@ -1,18 +1,187 @@
+import asyncio
 import logging
 import json
+import os
 import pathlib
-from fastapi import FastAPI, UploadFile, File, Form, Request, Depends
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from fastapi import FastAPI, UploadFile, File, Form, Request, Response, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import uvicorn
-from typing import Annotated
-from appium_automations import Postcard, Recipient
+from typing import Annotated, List, Optional
+from models import Postcard, Recipient
 
+from image_processing import InvalidImageError, LowResolutionError, preprocess_image
+from image_store import ImageStore, ImageTooLargeError
+from metrics import metrics
+from postal_codes import InvalidRecipientError, PostalCodeIndex
+from postcard_events import PostcardEvents
+from postcard_queue import CANCELLED, FAILED, SENT
 from scheduler import PostcardScheduler
-from pydantic import BaseModel
-
-app = FastAPI(debug=True)
+from pydantic import BaseModel, ValidationError
 
 IMAGE_FOLDER = "images/"
-scheduler = PostcardScheduler()
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_IMAGE_SIZE = int(os.environ.get('MAX_IMAGE_SIZE', 32 * 1024 * 1024))
+# Seconds between two comments keeping an idle event stream open through proxies
+EVENT_KEEPALIVE_INTERVAL = 15
+# Seconds the estimated send time has to move before subscribed clients are told
+EVENT_ETA_TOLERANCE = 60
+FINAL_STATES = (SENT, FAILED, CANCELLED)
+image_store = ImageStore(IMAGE_FOLDER)
+image_process_pool: ProcessPoolExecutor = None
+postal_code_index: Optional[PostalCodeIndex] = None
+postcard_events: PostcardEvents = None
+scheduler: PostcardScheduler = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the scheduler and the image workers with the api. The spawned image workers
+    import this module again, so nothing may be started when it is imported.
+    """
+    global image_process_pool, postal_code_index, postcard_events, scheduler
+    # Forking would copy the threads of the scheduler, adb and logging in whatever state they are
+    image_process_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+    postal_code_index = PostalCodeIndex.load()
+    # The scheduler publishes to the broker, which computes the statuses through the scheduler
+    postcard_events = PostcardEvents(lambda postcard_ids: scheduler.postcard_statuses(postcard_ids))
+    scheduler = PostcardScheduler(on_change=postcard_events.publish)
+    yield
+    scheduler.shutdown()
+    image_process_pool.shutdown()
+
+
+app = FastAPI(debug=True, lifespan=lifespan)
+
+
+class PostcardRequest(BaseModel):
+    """
+    Dataclass for storing one postcard of a batch submission
+    """
+    recipient: Recipient
+    description: str
+    # The file name of one of the uploaded images, may be omitted if only one image is uploaded
+    image: Optional[str] = None
+
+
+def validate_recipient(recipient: Recipient):
+    """
+    Checks the postal code and location of a recipient against the postal code index
+
+    Raises:
+        InvalidRecipientError: If they do not combine
+
+    Returns:
+        Recipient: The recipient with the location exactly as shown in the app
+    """
+    if postal_code_index is None:
+        # Reported once at startup and by /readyz
+        return recipient
+    location = postal_code_index.validate(recipient.postal_code, recipient.location)
+    return recipient.copy(update={"location": location})
+
+
+def parse_postcard_requests(body: str):
+    """
+    Parses and validates all postcards of a batch submission in one pass,
+    the body is either a json array or newline delimited json
+
+    Returns:
+        List[PostcardRequest]: The validated postcards
+    """
+    try:
+        stripped = body.strip()
+        if stripped.startswith('['):
+            items = json.loads(stripped)
+        else:
+            items = [json.loads(line) for line in stripped.splitlines() if line.strip()]
+    except json.JSONDecodeError as error:
+        raise HTTPException(status_code=422, detail=f"Invalid json: {error}") from error
+
+    requests, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            request = PostcardRequest.parse_obj(item)
+            request.recipient = validate_recipient(request.recipient)
+            requests.append(request)
+        except ValidationError as error:
+            errors.append({"index": index, "errors": error.errors()})
+        except InvalidRecipientError as error:
+            errors.append({"index": index, "errors": str(error),
+                           "suggestions": error.suggestions})
+
+    if errors:
+        raise HTTPException(status_code=422, detail=errors)
+    if not requests:
+        raise HTTPException(status_code=422, detail="No postcards submitted")
+    return requests
+
+
+async def save_image(image: UploadFile):
+    """
+    Streams an uploaded image to disk chunk by chunk and preprocesses it
+    for the postcard in the process pool, the file io runs outside of the event loop
+
+    Returns:
+        str: The name of the processed image in the store
+    """
+    upload = await run_in_threadpool(image_store.open_upload, MAX_IMAGE_SIZE)
+    try:
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            await run_in_threadpool(upload.write, chunk)
+        original_digest = await run_in_threadpool(upload.close)
+
+        if name := await run_in_threadpool(image_store.processed_name, original_digest):
+            return name
+
+        name = await asyncio.get_running_loop().run_in_executor(
+            image_process_pool, preprocess_image, upload.temporary_path, image_store.folder)
+        await run_in_threadpool(image_store.set_processed_name, original_digest, name)
+        return name
+    except ImageTooLargeError as error:
+        raise HTTPException(status_code=413, detail=str(error)) from error
+    except (LowResolutionError, InvalidImageError) as error:
+        raise HTTPException(status_code=422, detail=str(error)) from error
+    finally:
+        await run_in_threadpool(upload.abort)
+
+
+@app.get("/healthz")
+def get_health():
+    """
+    Returns whether the api is running
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def get_readiness(response: Response):
+    """
+    Returns the bring up phase of every device, ready once at least one device can send postcards
+    """
+    ready = scheduler.is_ready()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "devices": scheduler.device_status(),
+            "recipients_validated": postal_code_index is not None}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Returns the queue depth, the cooldown of every device, the send outcomes and the
+    latency histograms of all device operations in the prometheus text format
+    """
+    metrics.set_gauge('postcard_queue_depth', scheduler.queue.qsize())
+    for name, seconds in scheduler.cooldowns().items():
+        metrics.set_gauge('device_cooldown_seconds', seconds, device=name)
+    return metrics.render()
+
 
 @app.get("/delay")
 def get_delay():
@@ -24,34 +193,161 @@ def get_delay():
 
 @app.post("/postcard")
 # def read_item(postcard: Postcard, image : UploadFile):
-async def read_item(image : UploadFile, postcard : str = Form(...)):
+async def read_item(image : UploadFile, postcard : str = Form(...),
+                    priority: int = Form(0), deadline: Optional[datetime] = Form(None)):
     """
     Send a postcard
     """
 
     response_postcard = json.loads(postcard)
 
+    recipient = Recipient(
+        first_name=response_postcard["recipient"]["first_name"],
+        last_name=response_postcard["recipient"]["last_name"],
+        postal_code=response_postcard["recipient"]["postal_code"],
+        location=response_postcard["recipient"]["location"],
+        address=response_postcard["recipient"]["address"],
+    )
+    try:
+        recipient = validate_recipient(recipient)
+    except InvalidRecipientError as error:
+        raise HTTPException(status_code=422, detail={
+            "message": str(error), "suggestions": error.suggestions}) from error
+
+    image_name = await save_image(image)
+
     postcard = Postcard(
-        recipient=Recipient(
-            first_name=response_postcard["recipient"]["first_name"],
-            last_name=response_postcard["recipient"]["last_name"],
-            postal_code=response_postcard["recipient"]["postal_code"],
-            location=response_postcard["recipient"]["location"],
-            address=response_postcard["recipient"]["address"],
-        ),
+        recipient=recipient,
         description=response_postcard["description"],
-        image_location=f"{image.filename}"
+        image_location=image_name
     )
 
-    # save the image
-    with open(f'{IMAGE_FOLDER}/{image.filename}', 'wb') as file:
-        content = await image.read()
-        file.write(content)
+    return {"id": scheduler.schedule_postcard(postcard, priority, deadline)}
+
+
+@app.get("/postcard/{postcard_id}")
+def get_postcard_status(postcard_id: int):
+    """
+    Returns the state of a postcard, its position in the queue and when it is expected to be sent
+    """
+    if (status := scheduler.postcard_status(postcard_id)) is None:
+        raise HTTPException(status_code=404, detail="No postcard with this id")
+    return status
+
+
+def status_changed(previous: dict, current: dict):
+    """
+    Returns whether a client has to be told about the current status,
+    an estimated send time moving by less than the tolerance is no change
+    """
+    if {**previous, "estimated_send_time": None, "updated_at": None} != \
+            {**current, "estimated_send_time": None, "updated_at": None}:
+        return True
+    if (previous["estimated_send_time"] is None) != (current["estimated_send_time"] is None):
+        return True
+    if previous["estimated_send_time"] is None:
+        return False
+    moved = abs(current["estimated_send_time"] - previous["estimated_send_time"])
+    return moved.total_seconds() > EVENT_ETA_TOLERANCE
+
+
+def format_event(status: dict):
+    """
+    Formats a status as a server-sent event
+    """
+    return f"event: status\ndata: {json.dumps(status, default=str)}\n\n"
+
+
+@app.get("/postcard/{postcard_id}/events")
+async def get_postcard_events(postcard_id: int, request: Request):
+    """
+    Streams the status of a postcard as server-sent events whenever its state,
+    position or estimated send time changes, until it is sent, failed or cancelled
+    """
+    # Subscribed before the first status, so no change in between is missed
+    events = postcard_events.subscribe(postcard_id)
+    status = await run_in_threadpool(scheduler.postcard_status, postcard_id)
+    if status is None:
+        postcard_events.unsubscribe(postcard_id, events)
+        raise HTTPException(status_code=404, detail="No postcard with this id")
+
+    async def stream(status):
+        try:
+            yield format_event(status)
+            while status["state"] not in FINAL_STATES and not await request.is_disconnected():
+                try:
+                    current = await asyncio.wait_for(events.get(), EVENT_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                # Only the latest of several statuses in a row is relevant
+                while not events.empty():
+                    current = events.get_nowait()
+
+                if status_changed(status, current):
+                    status = current
+                    yield format_event(status)
+        finally:
+            postcard_events.unsubscribe(postcard_id, events)
+
+    return StreamingResponse(stream(status), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
 
-    scheduler.schedule_postcard(postcard)
+
+@app.delete("/postcard/{postcard_id}")
+def cancel_postcard(postcard_id: int):
+    """
+    Cancel a postcard which was not sent yet
+    """
+    if not scheduler.cancel_postcard(postcard_id):
+        raise HTTPException(status_code=404, detail="No queued postcard with this id")
     return
 
 
+@app.get("/postcards/failed")
+def get_failed_postcards(limit: int = 100):
+    """
+    Returns the postcards which failed permanently with the reason of the failure
+    """
+    return scheduler.failed_postcards(limit)
+
+
+@app.post("/postcards")
+async def create_postcards(images: List[UploadFile], postcards: str = Form(...),
+                           priority: int = Form(0), deadline: Optional[datetime] = Form(None)):
+    """
+    Send many postcards sharing a few images, all postcards are queued atomically
+
+    Returns:
+        dict: The ids of the queued postcards in the order they were submitted
+    """
+    requests = parse_postcard_requests(postcards)
+
+    filenames = [image.filename for image in images]
+    for index, request in enumerate(requests):
+        if request.image is None and len(images) != 1:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Postcard {index} has to name its image if several are uploaded")
+        if request.image is not None and request.image not in filenames:
+            raise HTTPException(
+                status_code=422, detail=f"Postcard {index} uses unknown image {request.image}")
+
+    # Every image is stored once, however many postcards use it
+    stored_images = {}
+    for image in images:
+        stored_images[image.filename] = await save_image(image)
+
+    ids = scheduler.schedule_postcards([
+        Postcard(
+            recipient=request.recipient,
+            description=request.description,
+            image_location=stored_images[request.image or filenames[0]],
+        ) for request in requests
+    ], priority, deadline)
+    return {"ids": ids}
+
+
 if __name__ == "__main__":
     cwd = pathlib.Path(__file__).parent.resolve()
     uvicorn.run(app, host="0.0.0.0", port=5000, log_config=f"{cwd}/log.ini")
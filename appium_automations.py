@@ -5,39 +5,40 @@ This module contains all the code for the automations made with appium
 import logging
 import os
 import re
-from dataclasses import dataclass
-from time import sleep
-
-from appium import webdriver
+from contextlib import nullcontext
 from appium.options.android import UiAutomator2Options
 from appium.webdriver.common.appiumby import AppiumBy
 from dotenv import load_dotenv
 from datetime import datetime
-from pydantic import BaseModel
+from selenium.common.exceptions import WebDriverException
 
-load_dotenv()
+from appium_session import NEW_COMMAND_TIMEOUT, AppiumSessionManager, looking_up
+from driver_trace import TRACE_FOLDER, DriverRecorder
+import locators
+from locators import INPUT_FIELD_CLASS, SWITCH_CLASS, Locator
+from metrics import metrics, timed
+from models import (STEP_CONFIRMED, STEP_IMAGE, STEP_MESSAGE, STEP_RECIPIENT, STEP_SENT,
+                    STEP_TERMS, Postcard, Recipient)
+from screens import LOGIN_SCREENS, Screen, classify_screen
+from ui_snapshot import SnapshotElement, UiSnapshot
+from waits import WaitConfig, wait_until
 
+# Lookup modes, either per element round trips or one page source snapshot per lookup
+LOOKUP_ELEMENTS = 'elements'
+LOOKUP_SNAPSHOT = 'snapshot'
 
-# @dataclass
-class Recipient(BaseModel):
-    """
-    Dataclass for storing the recipients information
-    """
-    first_name: str
-    last_name: str
-    address: str
-    postal_code: str
-    location: str
+KEYCODE_PASTE = 279
 
+# Upper bound of screen transitions in one flow, protecting against loops between screens
+MAX_FLOW_TRANSITIONS = 40
 
-# @dataclass
-class Postcard(BaseModel):
+
+class PermanentSendError(Exception):
     """
-    Dataclass for storing all metadata of a postcard
+    Raised when a postcard can not be sent as it is, so retrying it is pointless
     """
-    recipient: Recipient
-    image_location: str
-    description: str
+
+load_dotenv()
 
 
 class AppiumAutomationHandler:
@@ -45,263 +46,508 @@ class AppiumAutomationHandler:
     A class to handle all the automations performed by appium
     """
 
-    def __init__(self, device_id):
+    def __init__(self, device_id, appium_url='http://127.0.0.1:4723', system_port=None,
+                 swissid_username=None, swissid_password=None, wait_config=None,
+                 lookup_mode=None, session=None):
         # Appium
         options = UiAutomator2Options()
-        # options.udid = device_id
-        # Set the connection timeout to 2 days
-        options.new_command_timeout = 3600 * 48
-
-        # print(options.udid)
-        print(options.platform_name)
-        print(options.automation_name)
-
-        self.driver = webdriver.Remote(
-            'http://127.0.0.1:4723', options=options)
-
-        self.driver.implicitly_wait(20)
+        options.udid = device_id
+        # Every device on the same appium server needs its own uiautomator2 port
+        if system_port is not None:
+            options.system_port = system_port
+        # The session is kept alive by heartbeats instead of a very long timeout
+        options.new_command_timeout = NEW_COMMAND_TIMEOUT
+
+        self.device_id = device_id
+        self.swissid_username = swissid_username or os.environ.get(
+            'swissid_username')
+        self.swissid_password = swissid_password or os.environ.get(
+            'swissid_password')
+
+        # Recording the driver commands of the flows allows replaying them offline
+        self.recorder = None
+        if TRACE_FOLDER:
+            self.recorder = DriverRecorder(TRACE_FOLDER, device_id,
+                                           secrets=(self.swissid_password,))
+        self.session = session or AppiumSessionManager(device_id, appium_url, options,
+                                                       recorder=self.recorder)
+        self.wait_config: WaitConfig = wait_config or WaitConfig()
+        self.lookup_mode = lookup_mode or os.environ.get(
+            'LOOKUP_MODE', LOOKUP_SNAPSHOT)
+
+        self.input_field_class = INPUT_FIELD_CLASS
+        self.switch_class = SWITCH_CLASS
+
+        logging.info("Appium is now connected to device %s", device_id)
+
+    def close(self):
+        """
+        Stops keeping the appium session alive, e.g. because the device is stopped
+        """
+        self.session.stop()
 
-        self.button_class = "android.widget.Button"
-        self.text_class = "android.widget.TextView"
-        self.image_view_class = "android.widget.ImageView"
-        self.layout_class = "android.widget.LinearLayout"
-        self.input_field_class = "android.widget.EditText"
-        self.switch_class = "android.widget.Switch"
+    @property
+    def driver(self):
+        """
+        The driver of the current appium session, replaced if the session died
+        """
+        return self.session.driver
+
+    def __wait(self, predicate, target: str, optional=False, timeout=None):
+        if timeout is None:
+            timeout = self.wait_config.timeout_for(target, optional)
+        with metrics.span('ui_lookup_seconds', device=self.device_id, locator=target), \
+                looking_up(target):
+            return wait_until(predicate, timeout, self.wait_config.poll_interval)
+
+    def __find_elements(self, class_name: str, minimum_count=1, optional=False):
+        def predicate():
+            elements = self.driver.find_elements(
+                AppiumBy.CLASS_NAME, value=class_name)
+            return elements if len(elements) >= minimum_count else False
+
+        return self.__wait(predicate, class_name, optional) or []
+
+    def __set_field(self, field, value: str):
+        try:
+            # Replaces the whole value at once instead of typing it character by character
+            self.driver.execute_script('mobile: replaceElementValue',
+                                       {'elementId': field.id, 'text': value})
+        except WebDriverException:
+            field.clear()
+            field.send_keys(value)
+
+    def __paste_into_field(self, field, value: str):
+        self.driver.set_clipboard_text(value)
+        field.click()
+        field.clear()
+        self.driver.press_keycode(KEYCODE_PASTE)
+
+    def __mismatched_fields(self, values: dict):
+        """
+        Reads all input fields back from a single snapshot
 
-        logging.info("Appium is now connected to the selected device")
+        Returns:
+            List[int]: The indices of the fields not containing their value
+        """
+        fields = UiSnapshot(self.driver.page_source).by_class.get(self.input_field_class, [])
+        return [index for index, value in values.items()
+                if index >= len(fields) or fields[index].text.strip() != value.strip()]
 
-    def __find_button_by_text(self, target_text: str):
+    @timed('appium.fill_fields')
+    def __fill_fields(self, values: dict, verify=True):
+        """
+        Fills the input fields of the current form with as few round trips as possible,
+        falls back to pasting from the clipboard for fields which do not hold their value
 
-        sleep(1)
+        Args:
+            values (dict): The values keyed by the index of the input field
+            verify (bool): Whether to read the values back
 
-        buttons = self.driver.find_elements(
-            AppiumBy.CLASS_NAME, value=self.button_class)
-        for button in buttons:
-            try:
-                if button.text.find(target_text) != -1:
-                    return button
-            except Exception:
-                continue
-        return False
+        Returns:
+            bool: Whether all fields hold their value
+        """
+        input_fields = self.__find_elements(
+            self.input_field_class, minimum_count=max(values) + 1)
+        if len(input_fields) <= max(values):
+            return False
 
-    def __find_text(self, target_text: str):
+        for index, value in values.items():
+            self.__set_field(input_fields[index], value)
 
-        sleep(1)
+        if not verify:
+            return True
 
-        texts = self.driver.find_elements(
-            AppiumBy.CLASS_NAME, value=self.text_class)
+        if mismatched := self.__mismatched_fields(values):
+            logging.warning("Input fields %s did not take their value, pasting instead", mismatched)
+            for index in mismatched:
+                self.__paste_into_field(input_fields[index], values[index])
+            mismatched = self.__mismatched_fields(values)
 
-        for text in texts:
-            try:
-                if text.text.find(target_text) != -1:
-                    return text
-            except Exception:
-                continue
-        return False
+        return not mismatched
 
-    def __find_image(self, image_name: str):
-        sleep(1)
+    def __find_in_snapshot(self, locator: Locator, optional=False, timeout=None):
+        def predicate():
+            snapshot = UiSnapshot(self.driver.page_source)
+            if node := locator.find(snapshot):
+                return SnapshotElement(self.driver, node, snapshot)
+            return False
 
-        images = self.driver.find_elements(
-            AppiumBy.CLASS_NAME, value=self.layout_class
-        )
+        return self.__wait(predicate, locator.name, optional, timeout)
 
-        for image in images:
-            if content_desc := image.get_attribute('content-desc'):
-                if content_desc.find(image_name) != -1:
-                    return image
+    def __find_on_device(self, locator: Locator):
+        """
+        Filters the elements on the device with one round trip
+        """
+        elements = self.driver.find_elements(
+            AppiumBy.ANDROID_UIAUTOMATOR, locator.selector.uiautomator())
+        return elements[0] if elements else False
 
-        return False
+    def __find(self, locator: Locator, optional=False, timeout=None):
+        if self.lookup_mode == LOOKUP_SNAPSHOT:
+            return self.__find_in_snapshot(locator, optional, timeout)
+        return self.__wait(lambda: self.__find_on_device(locator), locator.name, optional, timeout)
 
 # ************************ Functions startin ***********************
 
     def __return_to_login_screen(self):
         for _ in range(2):
-            if button := self.__find_button_by_text("Cancel login"):
+            if button := self.__find(locators.CANCEL_LOGIN, optional=True):
                 button.click()
 
-    def login_with_swissid(self):
-        """
-        Logs into the app with swissid
+    def current_screen(self, exclude=(), timeout=None):
         """
-        if (button := self.__find_button_by_text("Login / registration")):
-            button.click()
+        Waits until a known screen is shown and identifies it from a single snapshot
 
-        if (button := self.__find_button_by_text("Login with SwissID")):
-            button.click()
+        Args:
+            exclude (tuple): Screens which are not accepted, e.g. the screen before an action
+            timeout (float, optional): The seconds to wait, defaults to the wait config
 
-        if self.__find_text("Log in to Swiss Post"):
-            input_fields = self.driver.find_elements(
-                AppiumBy.CLASS_NAME, value=self.input_field_class)
+        Returns:
+            Tuple[Screen, UiSnapshot]: The screen and the snapshot it was identified from
+        """
+        def predicate():
+            snapshot = UiSnapshot(self.driver.page_source)
+            screen = classify_screen(snapshot)
+            if screen == Screen.UNKNOWN or screen in exclude:
+                return False
+            return screen, snapshot
 
-            input_fields[0].send_keys(os.environ.get('swissid_username'))
-            input_fields[1].send_keys(os.environ.get('swissid_password'))
+        return self.__wait(predicate, 'screen', timeout=timeout) or (Screen.UNKNOWN, None)
 
-            if button := self.__find_button_by_text("Continue"):
-                button.click()
+    def __next_screen(self, previous: Screen, timeout=None):
+        """
+        Waits for the screen following an action, accepting the same screen again
+        if it did not change within the timeout
+        """
+        if previous is None:
+            return self.current_screen()
+
+        screen, snapshot = self.current_screen(exclude=(previous,), timeout=timeout)
+        if screen == Screen.UNKNOWN:
+            screen, snapshot = self.current_screen(
+                timeout=self.wait_config.optional_timeout)
+        return screen, snapshot
+
+    def __click(self, snapshot: UiSnapshot, locator: Locator):
+        if node := locator.find(snapshot):
+            SnapshotElement(self.driver, node, snapshot).click()
+            return True
+        return False
 
-            if self.__find_text("Confirm with SwissID App"):
-                logging.info("Waiting for swissid 2FA confirmation")
+    def __recording(self, flow: str, **arguments):
+        if self.recorder is None:
+            return nullcontext()
+        return self.recorder.recording(flow, **arguments)
 
-                while not self.__find_button_by_text("Create postcard"):
-                    if self.__find_text("Cancelled"):
-                        logging.error("The signing was cancelled from SwissID")
-                        self.__return_to_login_screen()
-                        return False
-                logging.info("Successful signin over swissid for account %s", os.environ.get(
-                    'swissid_username'))
+    @timed('appium.login_with_swissid')
+    def login_with_swissid(self):
+        """
+        Logs into the app with swissid
+        """
+        # Holding the session keeps the heartbeat from driving the device during the flow
+        with self.session.lock, self.__recording('login_with_swissid',
+                                                 swissid_username=self.swissid_username):
+            return self.__login_with_swissid()
+
+    def __login_with_swissid(self):
+        self.session.ensure_alive()
+        credentials_entered = False
+        previous = None
+
+        for _ in range(MAX_FLOW_TRANSITIONS):
+            screen, snapshot = self.__next_screen(previous)
+
+            if screen in (Screen.HOME, Screen.COOLDOWN):
+                logging.info("Successful signin over swissid for account %s",
+                             self.swissid_username)
                 return True
-            if self.__find_text("incorrect"):
+
+            if screen == Screen.WELCOME:
+                self.__click(snapshot, locators.LOGIN_REGISTRATION)
+            elif screen == Screen.LOGIN:
+                self.__click(snapshot, locators.LOGIN_WITH_SWISSID)
+            elif screen == Screen.SWISSID_LOGIN and not credentials_entered:
+                # The password is masked on screen and can not be read back
+                self.__fill_fields({0: self.swissid_username, 1: self.swissid_password},
+                                   verify=False)
+                credentials_entered = True
+
+                if button := self.__find(locators.SWISSID_CONTINUE):
+                    button.click()
+            elif screen == Screen.SWISSID_2FA:
+                logging.info("Waiting for swissid 2FA confirmation")
+                # The confirmation can take arbitrarily long, wait until the screen changes
+                while screen in (Screen.SWISSID_2FA, Screen.UNKNOWN):
+                    screen, snapshot = self.current_screen(
+                        exclude=(Screen.SWISSID_2FA,))
+                previous = None
+                continue
+            elif screen == Screen.SWISSID_CANCELLED:
+                logging.error("The signing was cancelled from SwissID")
+                self.__return_to_login_screen()
+                return False
+            elif screen == Screen.SWISSID_INCORRECT:
                 logging.info("Wrong credentials")
                 self.__return_to_login_screen()
                 return False
-        else:
-            logging.error("Not on login screen")
+            elif screen != Screen.SWISSID_LOGIN:
+                logging.error("Not on login screen but on %s", screen.value)
+                return False
+
+            previous = screen
 
         return False
 
+    @timed('appium.is_logged_in')
     def is_logged_in(self):
         """
         Function to check if a user is logged in already
         """
-        if (self.__find_button_by_text("Login / registration")):
-            return False
+        screen, _ = self.current_screen()
+        return screen not in LOGIN_SCREENS
 
-        if (self.__find_button_by_text("Login with SwissID")):
-            return False
+    def __enter_recipient(self, recipient: Recipient):
+        first_name_field_id = 3
+        last_name_field_id = 4
+        street_field_id = 5
+        postcode_field = 6
 
-        if self.__find_text("Log in to Swiss Post"):
+        if not self.__fill_fields({
+            first_name_field_id: recipient.first_name,
+            last_name_field_id: recipient.last_name,
+            street_field_id: recipient.address,
+            postcode_field: recipient.postal_code,
+        }):
+            logging.error("Failed to enter the recipient %s %s",
+                          recipient.first_name, recipient.last_name)
             return False
 
-        return True
+        # Check for location select
+        if self.__find(locators.SELECT_LOCATION, optional=True):
+            if button := self.__find(locators.LOCATION.format(recipient.location)):
+                button.click()
+            else:
+                raise PermanentSendError(
+                    f"The location {recipient.location} and postal code "
+                    f"{recipient.postal_code} do not combine")
 
-    def __insert_image_into_postcard(self, image_name: str):
-        if button := self.__find_button_by_text("Select image"):
+        if button := self.__find(locators.NEXT):
             button.click()
 
-        if button := self.__find_button_by_text("Allow"):
-            button.click()
+        return True
 
-        # Switch to the download section if neccessary
-        if self.__find_text("Recent"):
-            show_roots_xpath = '//android.widget.ImageButton[@content-desc="Show roots"]'
-            burger_menu = self.driver.find_element(
-                AppiumBy.XPATH, value=show_roots_xpath)
-            burger_menu.click()
-            if text := self.__find_text("Downloads"):
-                text.click()
+    def __enter_message(self, message):
+        if button := self.__find(locators.ENTER_MESSAGE):
+            button.click()
 
-        if image := self.__find_image(image_name):
-            image.click()
-        else:
-            logging.error("Image with name %s not found", image_name)
+        if not self.__fill_fields({0: message}):
+            logging.error("Failed to enter the message")
+            return False
 
-        if button := self.__find_text("N"):
+        # The editor sometimes ignores a tap on the checkmark, so it is tapped again
+        # only while the editor is still open
+        for _ in range(3):
+            if not (button := self.__find(locators.CHECKMARK, optional=True)):
+                break
             button.click()
+            if self.__wait(self.__editor_closed, 'editor closed', optional=True):
+                break
 
-        if button := self.__find_button_by_text("OK"):
-            logging.warning(
-                "Low resolution warning received for image %s", image_name)
-            button.click()
+        return True
 
-    def __enter_recipient(self, recipient: Recipient):
-        if button := self.__find_button_by_text("Recipient"):
-            button.click()
+    def __editor_closed(self):
+        return not locators.CHECKMARK.find(UiSnapshot(self.driver.page_source))
 
-        input_fields = self.driver.find_elements(
-            AppiumBy.CLASS_NAME, value=self.input_field_class)
+    def __handle_postcard_screen(self, screen: Screen, snapshot: UiSnapshot,
+                                 postcard: Postcard, progress: set):
+        """
+        Performs the action of the postcard flow belonging to the given screen
 
-        first_name_field_id = 3
-        last_name_field_id = 4
-        street_field_id = 5
-        postcode_field = 6
+        Returns:
+            bool: False if the flow can not continue
+        """
+        if screen == Screen.HOME:
+            return self.__click(snapshot, locators.CREATE_FREE_POSTCARD)
 
-        input_fields[first_name_field_id].send_keys(recipient.first_name)
-        input_fields[last_name_field_id].send_keys(recipient.last_name)
-        input_fields[street_field_id].send_keys(recipient.address)
-        input_fields[postcode_field].send_keys(recipient.postal_code)
+        if screen == Screen.IMAGE_SELECT:
+            locator = locators.NEXT if STEP_IMAGE in progress else locators.SELECT_IMAGE
+            return self.__click(snapshot, locator)
 
-        # Check for location select
-        if self.__find_text("Select location"):
-            if button := self.__find_text(recipient.location):
-                button.click()
+        if screen == Screen.PERMISSION_DIALOG:
+            return self.__click(snapshot, locators.ALLOW)
+
+        if screen == Screen.IMAGE_PICKER_RECENT:
+            # Switch to the download section
+            self.__click(snapshot, locators.SHOW_ROOTS)
+            if text := self.__find(locators.DOWNLOADS):
+                text.click()
+                return True
+            return False
+
+        if screen == Screen.IMAGE_PICKER:
+            if image := self.__find(locators.IMAGE.format(postcard.image_location)):
+                image.click()
             else:
-                logging.error(
-                    "The location %s and postal code %s do not combine",
-                    recipient.location, recipient.postal_code
-                )
+                logging.error("Image with name %s not found", postcard.image_location)
                 return False
 
-        if button := self.__find_button_by_text("Next"):
-            button.click()
-
-    def __enter_message(self, message):
-        if button := self.__find_button_by_text("Enter message"):
-            button.click()
+            if button := self.__find(locators.CHECKMARK):
+                button.click()
+            progress.add(STEP_IMAGE)
+            return True
 
-        input_fields = self.driver.find_elements(
-            AppiumBy.CLASS_NAME, value=self.input_field_class)
+        if screen == Screen.LOW_RESOLUTION_WARNING:
+            logging.warning(
+                "Low resolution warning received for image %s", postcard.image_location)
+            return self.__click(snapshot, locators.LOW_RESOLUTION_OK)
+
+        if screen in (Screen.RECIPIENT, Screen.MESSAGE):
+            if STEP_RECIPIENT not in progress and screen == Screen.RECIPIENT:
+                return self.__click(snapshot, locators.RECIPIENT)
+            if STEP_MESSAGE not in progress:
+                if not self.__enter_message(postcard.description):
+                    return False
+                progress.add(STEP_MESSAGE)
+                return True
+            return self.__click(snapshot, locators.NEXT)
 
-        input_fields[0].send_keys(message)
+        if screen == Screen.RECIPIENT_FORM:
+            if STEP_RECIPIENT in progress:
+                return self.__click(snapshot, locators.NEXT)
+            if not self.__enter_recipient(postcard.recipient):
+                return False
+            progress.add(STEP_RECIPIENT)
+            return True
 
-        for _ in range(3):
-            if button := self.__find_text("N"):
+        if screen == Screen.LOCATION_SELECT:
+            if self.__click(snapshot, locators.LOCATION.format(postcard.recipient.location)):
+                return True
+            raise PermanentSendError(
+                f"The location {postcard.recipient.location} and postal code "
+                f"{postcard.recipient.postal_code} do not combine")
+
+        if screen == Screen.TERMS:
+            # The switch keeps its state when the flow is resumed, it must not be toggled off
+            switches = snapshot.by_class.get(self.switch_class, [])
+            if switches and switches[0].attributes.get('checked') != 'true':
+                if gtg_accept_switch := self.__find_elements(self.switch_class):
+                    gtg_accept_switch[0].click()
+            progress.add(STEP_TERMS)
+            if button := self.__find(locators.SEND):
                 button.click()
+                progress.add(STEP_SENT)
+                return True
+            return False
+
+        if screen == Screen.SENT:
+            # The confirmation is only trusted right after the postcard was sent
+            if STEP_SENT in progress:
+                progress.add(STEP_CONFIRMED)
+            return self.__click(snapshot, locators.SENT_HOME)
+
+        if screen == Screen.NEXT:
+            return self.__click(snapshot, locators.NEXT)
+
+        logging.error("Unexpected screen %s while sending a postcard", screen.value)
+        return False
 
-    def send_free_postcard(self, postcard: Postcard):
+    @timed('appium.send_free_postcard')
+    def send_free_postcard(self, postcard: Postcard, progress: set = None, on_progress=None):
         """
-        Sends a free postcard over the api
+        Sends a free postcard over the api, identifying the current screen after
+        every action and jumping straight to its handler.
+        An interrupted flow is resumed from the current screen, skipping the completed steps.
 
         Args:
-            image_name (str): the name of the image to use
+            postcard (Postcard): The postcard to send
+            progress (set, optional): The steps completed by an earlier attempt, updated in place
+            on_progress (callable, optional): Called with the completed steps whenever a step is done
+
+        Raises:
+            PermanentSendError: If the postcard can not be sent as it is
+
+        Returns:
+            bool: Whether the postcard was sent and its confirmation screen was shown
         """
-        if not self.__find_button_by_text("Create free postcard"):
-            sleep(10)
+        progress = set() if progress is None else progress
+        with self.session.lock, self.__recording('send_free_postcard', postcard=postcard.dict(),
+                                                 progress=sorted(progress)):
+            return self.__send_free_postcard(postcard, progress, on_progress or (lambda steps: None))
 
-        if button := self.__find_button_by_text("Create free postcard"):
-            button.click()
+    def __send_free_postcard(self, postcard: Postcard, progress: set, on_progress):
+        self.session.ensure_alive()
+        previous = None
 
-        self.__insert_image_into_postcard(postcard.image_location)
+        change_timeout = None
 
-        if button := self.__find_button_by_text("Next"):
-            button.click()
+        for _ in range(MAX_FLOW_TRANSITIONS):
+            screen, snapshot = self.__next_screen(previous, change_timeout)
 
-        self.__enter_recipient(postcard.recipient)
-        self.__enter_message(postcard.description)
+            if STEP_SENT in progress and screen in (Screen.HOME, Screen.COOLDOWN):
+                return STEP_CONFIRMED in progress
 
-        if button := self.__find_button_by_text("Next"):
-            button.click()
+            if previous is None and progress and screen == Screen.HOME:
+                # The draft of the earlier attempt is gone, e.g. because the app was restarted
+                logging.info("Draft of the earlier attempt is gone, starting over")
+                progress.clear()
+                on_progress(set(progress))
 
-        if gtg_accept_switch := self.driver.find_element(AppiumBy.CLASS_NAME, self.switch_class):
-            gtg_accept_switch.click()
+            if screen == Screen.COOLDOWN:
+                logging.error("Can not send a postcard, the free postcard is not available")
+                return False
 
-        if button := self.__find_button_by_text("Send it now for free"):
-            button.click()
+            completed = len(progress)
+            with metrics.span('postcard_step_seconds', device=self.device_id, step=screen.value):
+                handled = self.__handle_postcard_screen(screen, snapshot, postcard, progress)
+            if not handled:
+                return False
+            # A verified step may end on the same screen, e.g. the overview after the message,
+            # so the screen is only awaited shortly to change
+            change_timeout = None
+            if len(progress) != completed:
+                on_progress(set(progress))
+                change_timeout = self.wait_config.optional_timeout
 
-        if button := self.__find_button_by_text("Home"):
-            button.click()
+            previous = screen
 
-        return True
+        logging.error("Postcard flow did not finish within %s steps", MAX_FLOW_TRANSITIONS)
+        return False
 
-    def check_if_waiting(self):
+    @timed('appium.check_if_waiting')
+    def check_if_waiting(self, expected=False):
         """
         A function that checks if the feature is disabled for a certain time.
+        The home screen and the cooldown banner are told apart from a single snapshot,
+        so an open slot is not probed for the banner until a timeout.
         Returns the time remaining in seconds.
+
+        Args:
+            expected (bool): Whether the banner has to appear, like after a postcard was sent,
+                it is then waited for up to the timeout of required elements
         """
-        if button := self.__find_button_by_text("Available again from"):
-            regex = re.compile(
-                r'.+(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})\sat\s(?P<hour>\d{2}):(?P<minute>\d{2}).*')
-            extracted = [m.groupdict() for m in regex.finditer(button.text)]
-            if len(extracted) == 1:
-                match = extracted[0]
-                available_again = datetime(int(match["year"]), int(match["month"]), int(
-                    match["day"]), int(match["hour"]), int(match["minute"]))
-                now = datetime.now()
-                duration = available_again - now
-
-                if duration.days < 0:
-                    return 0
-
-                return duration.seconds
+        if expected:
+            screen, snapshot = self.current_screen(
+                exclude=tuple(set(Screen) - {Screen.COOLDOWN}), timeout=self.wait_config.timeout)
+        else:
+            screen, snapshot = self.current_screen(timeout=self.wait_config.optional_timeout)
+        if screen != Screen.COOLDOWN:
+            return 0
+
+        regex = re.compile(
+            r'.+(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})\sat\s(?P<hour>\d{2}):(?P<minute>\d{2}).*')
+        banner = locators.AVAILABLE_AGAIN.find(snapshot)
+        extracted = [m.groupdict() for m in regex.finditer(banner.text)]
+        if len(extracted) == 1:
+            match = extracted[0]
+            available_again = datetime(int(match["year"]), int(match["month"]), int(
+                match["day"]), int(match["hour"]), int(match["minute"]))
+            now = datetime.now()
+            duration = available_again - now
+
+            if duration.days < 0:
+                return 0
+
+            return int(duration.total_seconds())
 
         return 0
@@ -0,0 +1,199 @@
+"""
+Module containing the management of appium sessions, which are reused across restarts of the process
+"""
+
+import json
+import logging
+import os
+from contextlib import contextmanager
+from threading import Event, RLock, Thread, local
+
+from appium import webdriver
+from appium.options.android import UiAutomator2Options
+from selenium.common.exceptions import InvalidSessionIdException, WebDriverException
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from metrics import metrics
+
+SESSIONS_FOLDER = 'appium_sessions'
+# Seconds between two health checks of an idle session
+HEARTBEAT_INTERVAL = int(os.environ.get('APPIUM_HEARTBEAT_INTERVAL', 60))
+# Seconds appium keeps a session without commands, the heartbeat keeps it alive while the
+# process runs and a restart within this time reattaches to the session
+NEW_COMMAND_TIMEOUT = int(os.environ.get('APPIUM_NEW_COMMAND_TIMEOUT', 600))
+
+# The ui target each thread is looking up, labelling the round trips of the lookup
+_lookup = local()
+
+
+@contextmanager
+def looking_up(target: str):
+    """
+    Labels the round trips of the current thread within the block with the name of the
+    looked up target. The selectors themselves contain values of the postcard, like the
+    image or the locality, and would create new metric series for every postcard.
+
+    Args:
+        target (str): The name of the target, like the name of its locator
+    """
+    previous = getattr(_lookup, 'target', '')
+    _lookup.target = target
+    try:
+        yield
+    finally:
+        _lookup.target = previous
+
+
+class AttachedRemote(webdriver.Remote):
+    """
+    A webdriver attaching to an existing appium session instead of starting a new one
+    """
+
+    def __init__(self, command_executor: str, session_id: str, options: UiAutomator2Options):
+        self.attached_session_id = session_id
+        super().__init__(command_executor, options=options)
+
+    def start_session(self, capabilities, browser_profile=None):
+        self.session_id = self.attached_session_id
+        self.caps = capabilities
+
+
+class AppiumSessionManager:
+    """
+    A class owning the appium session of one device. The session id is stored per device,
+    so a restarted process reattaches to the running session instead of paying the
+    cold start of uiautomator2. A heartbeat keeps the session warm and rebuilds it if it died.
+    A flow holds the lock while it drives the device, the heartbeat skips the session meanwhile.
+    """
+
+    def __init__(self, device_id: str, appium_url: str, options: UiAutomator2Options,
+                 folder=SESSIONS_FOLDER, heartbeat_interval: int = None, recorder=None):
+        self.device_id = device_id
+        self.appium_url = appium_url
+        self.options = options
+        self.heartbeat_interval = heartbeat_interval or HEARTBEAT_INTERVAL
+        self.recorder = recorder
+        self.lock = RLock()
+
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f'{device_id}.json')
+
+        self.driver = self.__attach() or self.__create()
+
+        self.stopped = Event()
+        self.heartbeat_thread = Thread(target=self.__heartbeat,
+                                       name=f'{device_id}-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def __load_session_id(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                stored = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # A session is only valid on the appium server which created it
+        if stored.get('appium_url') != self.appium_url:
+            return None
+        return stored.get('session_id')
+
+    def __save_session_id(self, session_id: str):
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'appium_url': self.appium_url, 'session_id': session_id}, file)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def __instrument(self, driver):
+        """
+        Measures every round trip of the driver, round trips of a lookup are labelled
+        with the name of its target
+        """
+        if self.recorder is not None:
+            self.recorder.attach(driver)
+        execute = driver.execute
+
+        def timed_execute(driver_command, params=None):
+            with metrics.span('webdriver_command_seconds', device=self.device_id,
+                              command=driver_command, locator=getattr(_lookup, 'target', '')):
+                return execute(driver_command, params)
+
+        driver.execute = timed_execute
+        return driver
+
+    def __is_alive(self, driver):
+        """
+        Checks the session with one cheap round trip. Only a session unknown to the server
+        or a refused connection count as dead, other errors like a timeout or a busy
+        uiautomator2 do not justify throwing away the session.
+        """
+        try:
+            driver.orientation
+        except InvalidSessionIdException:
+            return False
+        except MaxRetryError as error:
+            if isinstance(error.reason, NewConnectionError):
+                return False
+            logging.warning("Health check of the appium session of device %s failed: %s",
+                            self.device_id, error)
+        except WebDriverException as error:
+            logging.warning("Health check of the appium session of device %s failed: %s",
+                            self.device_id, error.msg)
+        return True
+
+    def __attach(self):
+        session_id = self.__load_session_id()
+        if session_id is None:
+            return None
+
+        driver = self.__instrument(AttachedRemote(self.appium_url, session_id, self.options))
+        if not self.__is_alive(driver):
+            logging.info("Stored appium session %s of device %s is gone",
+                         session_id, self.device_id)
+            return None
+
+        logging.info("Reattached to appium session %s of device %s", session_id, self.device_id)
+        return driver
+
+    def __create(self):
+        driver = self.__instrument(webdriver.Remote(self.appium_url, options=self.options))
+        # All waiting is done explicitly per lookup, the setting is kept by the session
+        driver.implicitly_wait(0)
+        self.__save_session_id(driver.session_id)
+        logging.info("Started appium session %s for device %s",
+                     driver.session_id, self.device_id)
+        return driver
+
+    def ensure_alive(self):
+        """
+        Checks the session and transparently replaces it by a new one if it died
+
+        Returns:
+            WebDriver: The driver of the live session
+        """
+        with self.lock:
+            if not self.__is_alive(self.driver):
+                logging.warning("Appium session of device %s died, starting a new one",
+                                self.device_id)
+                try:
+                    self.driver.quit()
+                except (WebDriverException, MaxRetryError):
+                    pass
+                self.driver = self.__create()
+            return self.driver
+
+    def __heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            # A flow driving the device keeps the session warm by itself
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.ensure_alive()
+            except Exception:
+                logging.exception("Heartbeat of the appium session of device %s failed",
+                                  self.device_id)
+            finally:
+                self.lock.release()
+
+    def stop(self):
+        """
+        Stops the heartbeat, the session itself is kept alive on the server for the next process
+        """
+        self.stopped.set()
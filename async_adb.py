@@ -0,0 +1,250 @@
+"""
+Module containing an asyncio client for the adb server, used for all device io
+"""
+
+import asyncio
+import os
+import struct
+import time
+from collections import defaultdict
+from threading import Lock, Thread
+from typing import Dict, List
+
+ADB_HOST = '127.0.0.1'
+ADB_PORT = 5037
+
+# The sync protocol allows at most 64KiB per DATA packet
+SYNC_DATA_MAX = 64 * 1024
+# Number of DATA packets buffered before waiting for the socket to drain
+SYNC_WRITE_BATCH = 16
+MAX_CONNECTIONS_PER_DEVICE = 4
+# Regular file with rw-r--r-- permissions, as sent by the adb command line client
+DEFAULT_FILE_MODE = 0o100644
+
+
+class AdbError(Exception):
+    """
+    Raised when the adb server or the device reports a failure
+    """
+
+
+class AdbConnection:
+    """
+    One socket connection to the adb server
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host=ADB_HOST, port=ADB_PORT):
+        """
+        Opens a new connection to the adb server
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, service: str):
+        """
+        Sends a host service request and waits for its status
+        """
+        payload = service.encode('utf-8')
+        self.writer.write(b'%04x' % len(payload) + payload)
+        await self.writer.drain()
+        await self.read_status()
+
+    async def read_status(self):
+        status = await self.reader.readexactly(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(await self.read_length_prefixed())
+        raise AdbError(f"Unexpected adb status {status!r}")
+
+    async def read_length_prefixed(self):
+        length = int(await self.reader.readexactly(4), 16)
+        return (await self.reader.readexactly(length)).decode('utf-8', errors='replace')
+
+    async def read_all(self):
+        return (await self.reader.read()).decode('utf-8', errors='replace')
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncAdbClient:
+    """
+    An asyncio adb client, pooling sync connections per device so consecutive pushes
+    skip the connection and transport handshake
+    """
+
+    def __init__(self, host=ADB_HOST, port=ADB_PORT):
+        self.host = host
+        self.port = port
+        self.sync_pools: Dict[str, List[AdbConnection]] = defaultdict(list)
+        self.device_limits: Dict[str, asyncio.Semaphore] = {}
+
+    def __limit(self, serial: str):
+        if serial not in self.device_limits:
+            self.device_limits[serial] = asyncio.Semaphore(MAX_CONNECTIONS_PER_DEVICE)
+        return self.device_limits[serial]
+
+    async def devices(self):
+        """
+        Returns the serials of all connected devices
+        """
+        connection = await AdbConnection.open(self.host, self.port)
+        try:
+            await connection.request('host:devices')
+            listing = await connection.read_length_prefixed()
+        finally:
+            connection.close()
+        return [line.split('\t')[0] for line in listing.splitlines()
+                if line.endswith('\tdevice')]
+
+    async def __transport(self, serial: str):
+        connection = await AdbConnection.open(self.host, self.port)
+        try:
+            await connection.request(f'host:transport:{serial}')
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def shell(self, serial: str, command: str):
+        """
+        Runs a shell command on the device, every command needs its own connection
+
+        Returns:
+            str: The output of the command
+        """
+        async with self.__limit(serial):
+            connection = await self.__transport(serial)
+            try:
+                await connection.request(f'shell:{command}')
+                return await connection.read_all()
+            finally:
+                connection.close()
+
+    async def __new_sync_connection(self, serial: str):
+        connection = await self.__transport(serial)
+        try:
+            await connection.request('sync:')
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def push(self, serial: str, source: str, destination: str, mode=DEFAULT_FILE_MODE):
+        """
+        Pushes a file to the device over a pooled sync connection,
+        writing the data in large batches
+        """
+        async with self.__limit(serial):
+            pooled = bool(self.sync_pools[serial])
+            connection = self.sync_pools[serial].pop() if pooled \
+                else await self.__new_sync_connection(serial)
+            try:
+                await self.__send_file(connection, source, destination, mode)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                if not pooled:
+                    raise
+                # The pooled connection was closed by the server in the meantime
+                connection = await self.__new_sync_connection(serial)
+                try:
+                    await self.__send_file(connection, source, destination, mode)
+                except Exception:
+                    connection.close()
+                    raise
+            except Exception:
+                connection.close()
+                raise
+            self.sync_pools[serial].append(connection)
+
+    @staticmethod
+    async def __send_file(connection: AdbConnection, source: str, destination: str, mode: int):
+        header = f'{destination},{mode}'.encode('utf-8')
+        connection.writer.write(b'SEND' + struct.pack('<I', len(header)) + header)
+
+        loop = asyncio.get_running_loop()
+        with open(source, 'rb') as file:
+            while True:
+                # Read a whole batch off the loop and hand it to the socket at once
+                batch = await loop.run_in_executor(
+                    None, file.read, SYNC_DATA_MAX * SYNC_WRITE_BATCH)
+                if not batch:
+                    break
+                for offset in range(0, len(batch), SYNC_DATA_MAX):
+                    chunk = batch[offset:offset + SYNC_DATA_MAX]
+                    connection.writer.write(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                await connection.writer.drain()
+
+        connection.writer.write(b'DONE' + struct.pack('<I', int(time.time())))
+        await connection.writer.drain()
+
+        status = await connection.reader.readexactly(4)
+        length = struct.unpack('<I', await connection.reader.readexactly(4))[0]
+        if status != b'OKAY':
+            message = await connection.reader.readexactly(length)
+            raise AdbError(message.decode('utf-8', errors='replace'))
+
+    async def is_installed(self, serial: str, package: str):
+        """
+        Returns whether a package is installed on the device
+        """
+        output = await self.shell(serial, f'pm path {package}')
+        return 'package:' in output
+
+    async def install(self, serial: str, apk: str):
+        """
+        Installs an apk on the device by pushing it and installing it with the package manager
+        """
+        remote_path = f'/data/local/tmp/{os.path.basename(apk)}'
+        await self.push(serial, apk, remote_path)
+        output = await self.shell(serial, f'pm install -r {remote_path}')
+        await self.shell(serial, f'rm -f {remote_path}')
+        if 'Success' not in output:
+            raise AdbError(f"Installing {apk} failed: {output.strip()}")
+
+    def close(self):
+        """
+        Closes all pooled connections
+        """
+        for connections in self.sync_pools.values():
+            for connection in connections:
+                connection.close()
+        self.sync_pools.clear()
+
+
+class AdbEventLoop:
+    """
+    An event loop running in a background thread, shared by all synchronous callers,
+    so device io of many devices is multiplexed instead of serialized
+    """
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, client=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='adb', daemon=True)
+        self.thread.start()
+        self.client = client or AsyncAdbClient()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the shared event loop, starting it on first use
+        """
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
+            return cls.__instance
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the shared loop and waits for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
@@ -1,8 +1,17 @@
 import logging
 from datetime import datetime
 
+from selenium.common.exceptions import WebDriverException
+
 from adb_automations import ADBAutomationHandler
-from appium_automations import AppiumAutomationHandler, Postcard
+from appium_automations import AppiumAutomationHandler, PermanentSendError, Postcard
+from async_adb import AdbError
+from device_config import (PHASE_CONNECTING_ADB, PHASE_CONNECTING_APPIUM, PHASE_LOGGING_IN,
+                           PHASE_PREPARING_VM, DeviceConfig)
+from models import SENDING_STEPS, STEP_CONFIRMED, STEP_SENT, SendOutcome, SendResult
+
+# Attempts of the send flow, every attempt resumes after the steps of the earlier ones
+SEND_ATTEMPTS = 2
 
 
 class AutomationHandler():
@@ -10,18 +19,33 @@ class AutomationHandler():
     Class to handle and coordinate automations
     """
 
-    def __init__(self, clear_downloads_folder=True):
-        # Initialize the handlers
-        self.adb_handler = ADBAutomationHandler()
-        self.appium_handler = AppiumAutomationHandler(
-            self.adb_handler.get_device_id())
-        self.clear_downloads_folder = clear_downloads_folder
+    def __init__(self, device_config: DeviceConfig = None, on_phase=None,
+                 adb_handler: ADBAutomationHandler = None,
+                 appium_handler: AppiumAutomationHandler = None):
+        if device_config is None:
+            device_config = DeviceConfig(name='default')
+        self.device_config = device_config
+        on_phase = on_phase or (lambda phase: None)
 
+        # Initialize the handlers
+        on_phase(PHASE_CONNECTING_ADB)
+        self.adb_handler = adb_handler or ADBAutomationHandler(serial=device_config.adb_serial)
+        on_phase(PHASE_CONNECTING_APPIUM)
+        self.appium_handler = appium_handler or AppiumAutomationHandler(
+            self.adb_handler.get_device_id(),
+            appium_url=device_config.appium_url,
+            system_port=device_config.system_port,
+            swissid_username=device_config.swissid_username,
+            swissid_password=device_config.swissid_password)
+
+        on_phase(PHASE_PREPARING_VM)
         self.adb_handler.prepare_vm()
 
         # Login the user if he isn't already
         self.logged_in = self.appium_handler.is_logged_in()
+        self.login_required = not self.logged_in
         if not self.logged_in:
+            on_phase(PHASE_LOGGING_IN)
             self.login()
 
         # Initialize the delay for sending another postcard
@@ -37,30 +61,109 @@ class AutomationHandler():
         else:
             logging.error("User is already logged in when attempting login")
 
-    def send_postcard(self, postcard: Postcard):
+    def send_postcard(self, postcard: Postcard, checkpoints: set = None, on_checkpoint=None):
         """
-        Sends a postcard if the user is logged in
+        Sends a postcard if the user is logged in, resuming after the completed steps.
+        A postcard only counts as sent once the confirmation screen was shown,
+        once send was pressed it is never sent again.
 
         Args:
-            image_location (str): The file location of the image
-            recipient (Recipient): The recipient of the postcard
-            message (str): The message to put on the postcard
+            postcard (Postcard): The postcard to send
+            checkpoints (set, optional): The steps completed by earlier attempts, updated in place
+            on_checkpoint (callable, optional): Called with the completed steps after every step
+
+        Returns:
+            SendResult: The outcome of the attempt
         """
+        checkpoints = set() if checkpoints is None else checkpoints
+        on_checkpoint = on_checkpoint or (lambda steps: None)
+
         if not self.logged_in:
-            logging.error("Failed to send postcard, not logged in")
-            return False
+            return SendResult(outcome=SendOutcome.RETRYABLE, reason="Not logged in")
+
+        if checkpoints & SENDING_STEPS:
+            # An earlier attempt was interrupted after pressing send
+            return self.__verify_sent(checkpoints)
+
+        if self.appium_handler.check_if_waiting() != 0:
+            return SendResult(outcome=SendOutcome.UNAVAILABLE,
+                              reason="The free postcard is not available yet")
+
+        try:
+            self.adb_handler.upload_image(postcard.image_location)
+
+            for attempt in range(SEND_ATTEMPTS):
+                if attempt > 0:
+                    logging.warning("Resuming the postcard after the steps %s",
+                                    sorted(checkpoints))
+                    # Brings the app back to the front if it crashed or was left
+                    self.adb_handler.prepare_vm()
+                if self.appium_handler.send_free_postcard(postcard, checkpoints, on_checkpoint):
+                    break
+                if STEP_SENT in checkpoints:
+                    # Resending after pressing send risks sending the postcard twice
+                    break
+        except PermanentSendError as error:
+            return SendResult(outcome=SendOutcome.PERMANENT, reason=str(error))
+        except (WebDriverException, AdbError, OSError) as error:
+            logging.exception("Sending the postcard failed")
+            if not checkpoints & SENDING_STEPS:
+                return SendResult(outcome=SendOutcome.RETRYABLE, reason=str(error))
+
+        if checkpoints & SENDING_STEPS:
+            return self.__verify_sent(checkpoints)
 
         if self.appium_handler.check_if_waiting() != 0:
-            logging.info(
-                "Need to wait %s seconds before sending another postcard", self.time_remaining)
-            return False
+            return SendResult(outcome=SendOutcome.UNAVAILABLE,
+                              reason="The free postcard was used without this postcard")
+
+        # Send was never pressed, so the next attempt starts over
+        return SendResult(outcome=SendOutcome.RETRYABLE,
+                          reason=f"The flow stopped after the steps {sorted(checkpoints)}")
+
+    def __verify_sent(self, checkpoints: set):
+        """
+        Decides on the outcome of a postcard after send was pressed. It is never sent again,
+        a postcard only counts as sent if the app confirmed it.
+
+        Returns:
+            SendResult: The outcome, never retryable
+        """
+        try:
+            waiting = self.appium_handler.check_if_waiting(expected=True) != 0
+        except (WebDriverException, AdbError, OSError):
+            logging.exception("Reading the cooldown after sending the postcard failed")
+            waiting = False
+
+        if STEP_CONFIRMED in checkpoints:
+            if not waiting:
+                logging.warning("The postcard was confirmed but the cooldown banner did not appear")
+            return SendResult(outcome=SendOutcome.SENT)
+        if waiting:
+            reason = "The postcard was sent without a confirmation, check the app before retrying"
+        else:
+            reason = "The flow stopped after pressing send and the free postcard is still " \
+                     "shown as available, check the app before retrying"
+        return SendResult(outcome=SendOutcome.PERMANENT, reason=reason)
 
-        self.adb_handler.upload_image(
-            postcard.image_location, clear_downloads_folder=self.clear_downloads_folder)
+    def prepare_postcard(self, postcard: Postcard):
+        """
+        Prepares a postcard while the account is waiting for its next free postcard,
+        so only the ui flow is left once the slot opens
 
-        outcome = self.appium_handler.send_free_postcard(postcard)
+        Args:
+            postcard (Postcard): The postcard to prepare
 
-        return outcome
+        Returns:
+            bool: Whether the postcard is ready to be sent
+        """
+        for _ in range(2):
+            self.adb_handler.upload_image(postcard.image_location)
+            if self.adb_handler.verify_image(postcard.image_location):
+                logging.info("Image %s is staged on device %s",
+                             postcard.image_location, self.adb_handler.get_device_id())
+                return True
+        return False
 
     def get_timeout_seconds(self):
         """
@@ -70,3 +173,9 @@ class AutomationHandler():
             _type_: _description_
         """
         return self.appium_handler.check_if_waiting()
+
+    def close(self):
+        """
+        Releases the device before it is stopped
+        """
+        self.appium_handler.close()
@@ -0,0 +1,201 @@
+"""
+Module containing the end to end benchmarks of the scheduler and the automations,
+run against simulated devices so no emulator, appium server or account is needed
+
+    python3 benchmark.py --sends 3 --devices 4 --postcards 12
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from adb_automations import ADBAutomationHandler
+from appium_automations import AppiumAutomationHandler
+from async_adb import AdbEventLoop
+from automation_handler import AutomationHandler
+from device_config import DeviceConfig
+from image_store import IMAGE_FOLDER
+from models import Postcard, Recipient, SendOutcome
+from scheduler import PostcardScheduler
+from simulation import (SimulatedAdbClient, SimulatedAutomationHandler, SimulatedClock,
+                        SimulatedDevice)
+from waits import WaitConfig
+
+IMAGE_NAME = 'benchmark.jpg'
+IMAGE_SIZE = 2 * 1024 * 1024
+
+
+def sample_postcard(index: int = 0):
+    """
+    Returns a postcard using the benchmark image
+    """
+    return Postcard(
+        recipient=Recipient(first_name="Erika", last_name=f"Muster {index}",
+                            address="Bahnhofstrasse 1", postal_code="8001", location="Zürich"),
+        image_location=IMAGE_NAME,
+        description=f"Greetings number {index}")
+
+
+def percentile(values, fraction: float):
+    """
+    Returns the value below which the given fraction of the values lies
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def wait_until_sent(scheduler: PostcardScheduler, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not scheduler.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # Let the last postcard leave the worker
+    time.sleep(0.5)
+
+
+def benchmark_ingestion(postcards: int, batch_size: int, devices: int):
+    """
+    Measures how fast postcards are queued, one by one and in batches
+    """
+    configs = [DeviceConfig(name=f'ingest-{index}') for index in range(devices)]
+    # The devices never open a slot, so the queue only grows
+    scheduler = PostcardScheduler(
+        configs, queue_file='ingestion.sqlite3',
+        automation_factory=lambda config, on_phase: SimulatedAutomationHandler(
+            config, on_phase, available_in=10 ** 9))
+
+    started = time.perf_counter()
+    for index in range(postcards):
+        scheduler.schedule_postcard(sample_postcard(index))
+    single = postcards / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for offset in range(0, postcards, batch_size):
+        scheduler.schedule_postcards(
+            [sample_postcard(index) for index in range(offset, min(postcards, offset + batch_size))])
+    batched = postcards / (time.perf_counter() - started)
+    scheduler.shutdown()
+
+    print("Ingestion")
+    print(f"  single requests        {single:10.1f} postcards/s")
+    print(f"  batches of {batch_size:<4}        {batched:10.1f} postcards/s")
+
+
+def benchmark_send(sends: int, time_scale: float, wait_config: WaitConfig):
+    """
+    Measures the latency of sending postcards through the real automations on a simulated device
+    """
+    clock = SimulatedClock(time_scale)
+    device = SimulatedDevice('emulator-5554', clock)
+    adb_client = SimulatedAdbClient([device], clock)
+    adb = AdbEventLoop(adb_client)
+
+    handler = AutomationHandler(
+        DeviceConfig(name='benchmark', adb_serial=device.serial),
+        adb_handler=ADBAutomationHandler(serial=device.serial, adb=adb),
+        appium_handler=AppiumAutomationHandler(
+            device.serial, session=device.session, wait_config=wait_config))
+
+    durations = []
+    driver_seconds, adb_seconds = defaultdict(float), defaultdict(float)
+    driver_counts, adb_counts = Counter(), Counter()
+    for index in range(sends):
+        device.app.expire_cooldown()
+        device.driver.stats.reset()
+        adb_client.stats.reset()
+
+        started = time.perf_counter()
+        result = handler.send_postcard(sample_postcard(index))
+        durations.append(time.perf_counter() - started)
+        if result.outcome != SendOutcome.SENT:
+            print(f"  send {index} failed: {result.outcome.value} {result.reason}")
+
+        for command, seconds in device.driver.stats.seconds.items():
+            driver_seconds[command] += seconds
+        for command, seconds in adb_client.stats.seconds.items():
+            adb_seconds[command] += seconds
+        driver_counts.update(device.driver.stats.counts)
+        adb_counts.update(adb_client.stats.counts)
+
+    total = sum(durations)
+    driver_total = sum(driver_seconds.values())
+    adb_total = sum(adb_seconds.values())
+    print(f"Send ({sends} postcards, {len(device.app.sent_postcards)} arrived)")
+    print(f"  latency mean / max     {statistics.mean(durations):8.2f} s / {max(durations):.2f} s")
+    print(f"  round trips per send   {sum(driver_counts.values()) / sends:8.1f} driver, "
+          f"{sum(adb_counts.values()) / sends:.1f} adb")
+    print(f"  time per send          {driver_total / sends:8.2f} s driver, "
+          f"{adb_total / sends:.2f} s adb, "
+          f"{(total - driver_total - adb_total) / sends:.2f} s waiting")
+    for command, seconds in sorted(driver_seconds.items(), key=lambda item: -item[1]):
+        print(f"    {command:<20} {driver_counts[command] / sends:6.1f} x "
+              f"{seconds / sends:6.2f} s")
+    for command, seconds in sorted(adb_seconds.items(), key=lambda item: -item[1]):
+        print(f"    adb {command:<16} {adb_counts[command] / sends:6.1f} x "
+              f"{seconds / sends:6.2f} s")
+
+
+def benchmark_scheduler(devices: int, postcards: int, time_scale: float):
+    """
+    Measures how close to the end of the cooldown the scheduler starts the next postcard
+    """
+    clock = SimulatedClock(time_scale)
+    handlers = []
+
+    def automation_factory(config, on_phase):
+        handler = SimulatedAutomationHandler(config, on_phase, clock)
+        handlers.append(handler)
+        return handler
+
+    configs = [DeviceConfig(name=f'device-{index}') for index in range(devices)]
+    scheduler = PostcardScheduler(configs, queue_file='scheduler.sqlite3',
+                                  automation_factory=automation_factory)
+    # The simulated app unlocks the postcard exactly at the end of the cooldown
+    scheduler.safe_timeout = 0
+    scheduler.schedule_postcards([sample_postcard(index) for index in range(postcards)])
+
+    expected = clock.scaled(86400) * (postcards / devices) + 5
+    wait_until_sent(scheduler, expected * 2)
+    scheduler.shutdown()
+
+    # The first slot of every device is open from the start
+    lateness = [(started - available_at).total_seconds() * 1000
+                for handler in handlers for available_at, started in handler.sends[1:]]
+    sent = sum(len(handler.sends) for handler in handlers)
+    print(f"Scheduler ({devices} devices, {sent}/{postcards} sent, "
+          f"cooldown of {clock.scaled(86400):.1f} s)")
+    if lateness:
+        print(f"  wake lateness          {statistics.mean(lateness):8.1f} ms mean, "
+              f"{percentile(lateness, 0.5):.1f} ms p50, {percentile(lateness, 0.99):.1f} ms p99")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sends', type=int, default=3, help="postcards sent through the ui flow")
+    parser.add_argument('--devices', type=int, default=4, help="devices of the scheduler")
+    parser.add_argument('--postcards', type=int, default=12,
+                        help="postcards sent by the scheduler")
+    parser.add_argument('--ingest', type=int, default=2000, help="postcards queued for ingestion")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--time-scale', type=float, default=0.00005,
+                        help="real seconds per simulated second of the scheduler")
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help="real seconds per simulated second of the ui flow")
+    arguments = parser.parse_args()
+
+    # Everything the automations store on disk goes into a temporary folder
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        os.makedirs(IMAGE_FOLDER)
+        with open(os.path.join(IMAGE_FOLDER, IMAGE_NAME), 'wb') as file:
+            file.write(os.urandom(IMAGE_SIZE))
+
+        benchmark_ingestion(arguments.ingest, arguments.batch_size, arguments.devices)
+        benchmark_send(arguments.sends, arguments.latency_scale, WaitConfig())
+        benchmark_scheduler(arguments.devices, arguments.postcards, arguments.time_scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Module containing the configuration of the devices and accounts used for sending postcards
+"""
+
+import json
+import logging
+import os
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+load_dotenv()
+
+DEFAULT_APPIUM_URL = 'http://127.0.0.1:4723'
+DEFAULT_DEVICES_FILE = 'devices.json'
+
+# Phases a device passes through while it is brought up
+PHASE_PENDING = 'pending'
+PHASE_BOOTING = 'booting'
+PHASE_CONNECTING_ADB = 'connecting_adb'
+PHASE_CONNECTING_APPIUM = 'connecting_appium'
+PHASE_PREPARING_VM = 'preparing_vm'
+PHASE_LOGGING_IN = 'logging_in'
+PHASE_READY = 'ready'
+# The emulator of the device is stopped until its next slot
+PHASE_PARKED = 'parked'
+PHASE_FAILED = 'failed'
+
+
+class DeviceConfig(BaseModel):
+    """
+    Dataclass for storing the configuration of one device and the account logged in on it
+    """
+    name: str
+    adb_serial: Optional[str] = None
+    appium_url: str = DEFAULT_APPIUM_URL
+    system_port: Optional[int] = None
+    swissid_username: Optional[str] = None
+    swissid_password: Optional[str] = None
+    # The avd to boot and stop on demand, devices without one are expected to run already
+    avd: Optional[str] = None
+
+
+def load_device_configs(path: Optional[str] = None) -> List[DeviceConfig]:
+    """
+    Loads the device configurations from a json file containing a list of devices.
+    Falls back to a single device using the credentials from the .env file.
+
+    Args:
+        path (str, optional): The path of the json file, defaults to $DEVICES_FILE or devices.json
+
+    Returns:
+        List[DeviceConfig]: The configurations of all devices
+    """
+    path = path or os.environ.get('DEVICES_FILE', DEFAULT_DEVICES_FILE)
+
+    if os.path.isfile(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            configs = [DeviceConfig(**entry) for entry in json.load(file)]
+        logging.info("Loaded %s device configurations from %s",
+                     len(configs), path)
+        return configs
+
+    return [DeviceConfig(
+        name='default',
+        adb_serial=os.environ.get('adb_serial'),
+        appium_url=os.environ.get('appium_url', DEFAULT_APPIUM_URL),
+        swissid_username=os.environ.get('swissid_username'),
+        swissid_password=os.environ.get('swissid_password'),
+    )]
@@ -0,0 +1,406 @@
+"""
+Module containing the recording of driver commands into trace files and a driver
+replaying them offline, so flow and locator changes can be measured without a device
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock, RLock, get_ident
+from time import perf_counter
+from typing import Dict, List, Optional
+
+from appium import webdriver
+from appium.options.android import UiAutomator2Options
+from appium.webdriver.common.appiumby import AppiumBy
+
+from locators import Selector
+from ui_snapshot import UiNode, UiSnapshot
+
+TRACE_FOLDER = os.environ.get('TRACE_FOLDER')
+REDACTED = '***'
+ELEMENT_KEY = 'element-6066-11e4-a52e-4f735466cecf'
+
+# Commands which only read the ui, every other command is an action changing it
+READ_COMMANDS = {'getPageSource', 'findElement', 'findElements', 'getElementText',
+                 'getElementAttribute', 'getElementRect', 'getScreenOrientation', 'getClipboard'}
+# Commands answered without the trace
+SESSION_COMMANDS = {'newSession', 'setTimeouts', 'quit'}
+# Scripts typing a value into a field
+TYPING_SCRIPTS = {'mobile: replaceElementValue'}
+
+
+def redact_typing(command: str, params: dict):
+    """
+    Returns the params of a command with every value typed into the ui replaced.
+    Typing may send the value character by character or base64 encoded, which
+    no search for the secrets in the written line would find.
+
+    Args:
+        command (str): The name of the driver command
+        params (dict): The params of the command
+
+    Returns:
+        dict: The params safe to be written to a trace
+    """
+    if command == 'sendKeysToElement':
+        return {**params, 'text': REDACTED, 'value': [REDACTED]}
+    if command == 'setClipboard':
+        return {**params, 'content': REDACTED}
+    if command in ('executeScript', 'w3cExecuteScript') and params.get('script') in TYPING_SCRIPTS:
+        return {**params, 'args': [{**argument, 'text': REDACTED}
+                                   if isinstance(argument, dict) and 'text' in argument
+                                   else argument for argument in params.get('args', [])]}
+    return params
+
+
+class DriverRecorder:
+    """
+    Records the raw commands and responses of a driver with their duration into
+    a gzipped json lines file, storing every distinct page source once.
+    Typed values and the secrets are never written.
+    """
+
+    def __init__(self, folder: str, device_id: str, secrets=()):
+        self.folder = folder
+        self.device_id = device_id
+        # Values which must never be written to a trace, like the password
+        self.secrets = [json.dumps(secret)[1:-1] for secret in secrets if secret]
+        self.lock = Lock()
+        self.file = None
+        self.thread = None
+        self.sources = set()
+
+    def attach(self, driver):
+        """
+        Records the commands of the driver while a recording is running
+
+        Returns:
+            WebDriver: The driver
+        """
+        executor = driver.command_executor
+        execute = executor.execute
+
+        def recorded_execute(command, params):
+            started = perf_counter()
+            response = execute(command, params)
+            # Commands of other threads, like the heartbeat, are not part of the flow
+            if self.file is not None and get_ident() == self.thread:
+                self.__record(command, params, response, perf_counter() - started)
+            return response
+
+        executor.execute = recorded_execute
+        return driver
+
+    def __write(self, entry: dict):
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        for secret in self.secrets:
+            line = line.replace(secret, REDACTED)
+        self.file.write(line + '\n')
+
+    def __record(self, command: str, params: dict, response: dict, seconds: float):
+        params = redact_typing(
+            command, {key: value for key, value in (params or {}).items() if key != 'sessionId'})
+        response = {key: value for key, value in (response or {}).items() if key != 'sessionId'}
+        if command == 'getClipboard':
+            response['value'] = REDACTED
+
+        with self.lock:
+            if self.file is None:
+                return
+            value = response.get('value')
+            if command == 'getPageSource' and isinstance(value, str):
+                digest = hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+                if digest not in self.sources:
+                    self.sources.add(digest)
+                    self.__write({'source': digest, 'xml': value})
+                response['value'] = {'$source': digest}
+            self.__write({'c': command, 'p': params, 'r': response, 't': round(seconds, 4)})
+
+    @contextmanager
+    def recording(self, flow: str, **arguments):
+        """
+        Records all commands sent by the current thread within the block into a new trace
+
+        Args:
+            flow (str): The name of the recorded flow
+            arguments: The arguments needed to run the flow again
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(
+            self.folder, f'{self.device_id}-{flow}-{datetime.now():%Y%m%d-%H%M%S}.trace.gz')
+        with self.lock:
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+            self.thread = get_ident()
+            self.sources = set()
+            self.__write({'flow': flow, 'device': self.device_id,
+                          'started': datetime.now().isoformat(), 'arguments': arguments})
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.file.close()
+                self.file = None
+            logging.info("Recorded the %s flow of device %s to %s", flow, self.device_id, path)
+
+
+@dataclass
+class Trace:
+    """
+    Dataclass for storing a loaded trace, the header and the commands in order
+    """
+    header: dict
+    commands: List[dict]
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a trace file written by the recorder
+        """
+        sources = {}
+        header, commands = None, []
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                if header is None:
+                    header = entry
+                elif 'source' in entry:
+                    sources[entry['source']] = entry['xml']
+                else:
+                    value = entry['r'].get('value')
+                    if isinstance(value, dict) and '$source' in value:
+                        entry['r']['value'] = sources[value['$source']]
+                    commands.append(entry)
+        return cls(header, commands)
+
+    @property
+    def recorded_seconds(self):
+        """
+        The time spent in round trips during the recording
+        """
+        return sum(entry['t'] for entry in self.commands)
+
+
+@dataclass
+class Segment:
+    """
+    Dataclass for storing the reads between two actions of a trace and the action ending them
+    """
+    reads: List[dict] = field(default_factory=list)
+    action: Optional[dict] = None
+
+
+class ReplayExecutor:
+    """
+    A command executor answering the commands of a driver from a trace.
+    The trace is split at every action, reads are answered from the recorded reads
+    since the last action and every action moves on to the next segment.
+    Lookups which were not recorded are resolved against the recorded page source.
+    Typed values are redacted like in the recording before they are compared.
+    """
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+        self._commands = {}
+        self.segments = [Segment()]
+        for entry in trace.commands:
+            if entry['c'] in READ_COMMANDS or entry['c'] in SESSION_COMMANDS:
+                self.segments[-1].reads.append(entry)
+            else:
+                self.segments[-1].action = entry
+                self.segments.append(Segment())
+
+        self.segment = 0
+        self.cursors = defaultdict(int)
+        self.synthetic: Dict[str, UiNode] = {}
+        self.round_trips = 0
+        self.replayed_seconds = 0.0
+        self.serving_seconds = 0.0
+        self.divergences: List[str] = []
+
+    def execute(self, command: str, params: dict):
+        started = perf_counter()
+        try:
+            params = redact_typing(
+                command, {key: value for key, value in (params or {}).items() if key != 'sessionId'})
+            return self.__serve(command, params)
+        finally:
+            if command != 'newSession':
+                self.round_trips += 1
+            self.serving_seconds += perf_counter() - started
+
+    def __diverged(self, message: str):
+        self.divergences.append(f"Segment {self.segment}: {message}")
+        return {'status': 500, 'value': {'error': 'unknown error', 'message': message}}
+
+    def __serve(self, command: str, params: dict):
+        if command == 'newSession':
+            return {'value': {'sessionId': 'replay', 'capabilities': {'platformName': 'Android'}}}
+        if command in SESSION_COMMANDS:
+            return {'value': None}
+        if params.get('id') in self.synthetic:
+            return self.__serve_synthetic(command, params)
+        if command in READ_COMMANDS:
+            return self.__read(command, params)
+        return self.__act(command, params)
+
+    def __read(self, command: str, params: dict):
+        reads = self.segments[self.segment].reads
+        matching = [entry for entry in reads if entry['c'] == command and entry['p'] == params]
+        if not matching and command == 'getPageSource':
+            matching = self.__latest_sources()
+        if not matching:
+            # E.g. the text of an element read before the last action
+            matching = [entry for segment in self.segments[:self.segment + 1]
+                        for entry in segment.reads
+                        if entry['c'] == command and entry['p'] == params][-1:]
+
+        if matching:
+            # Repeated reads, like polling for a screen, walk through the recorded responses
+            key = (self.segment, command, json.dumps(params, sort_keys=True))
+            entry = matching[min(self.cursors[key], len(matching) - 1)]
+            self.cursors[key] += 1
+            self.replayed_seconds += entry['t']
+            return entry['r']
+
+        if command in ('findElement', 'findElements'):
+            return self.__find(command, params)
+        return self.__diverged(f"{command} {params} was not recorded")
+
+    def __latest_sources(self):
+        for segment in reversed(self.segments[:self.segment + 1]):
+            sources = [entry for entry in segment.reads if entry['c'] == 'getPageSource']
+            if sources:
+                return sources[-1:]
+        return []
+
+    def __find(self, command: str, params: dict):
+        """
+        Resolves a lookup which was not recorded against the latest page source
+        """
+        sources = self.__latest_sources()
+        if not sources:
+            return self.__diverged(f"No page source to resolve {params}")
+        nodes = self.resolve(UiSnapshot(sources[0]['r']['value']), params['using'], params['value'])
+        if nodes is None:
+            return self.__diverged(f"Locating by {params['using']} is not supported offline")
+        self.replayed_seconds += self.__mean_seconds(command)
+
+        elements = []
+        for node in nodes:
+            element_id = f'replay-{len(self.synthetic)}'
+            self.synthetic[element_id] = node
+            elements.append({ELEMENT_KEY: element_id, 'ELEMENT': element_id})
+        if command == 'findElements':
+            return {'value': elements}
+        if not elements:
+            return {'status': 404, 'value': {'error': 'no such element',
+                                             'message': f"No element {params['value']}"}}
+        return {'value': elements[0]}
+
+    @staticmethod
+    def resolve(snapshot: UiSnapshot, using: str, value: str):
+        """
+        Returns the nodes of a snapshot matching a locator
+
+        Returns:
+            List[UiNode]: The matching nodes or None if the locator is not supported
+        """
+        if using == 'class name':
+            return snapshot.by_class.get(value, [])
+        if using == 'id':
+            return [node for node in snapshot.nodes if node.resource_id == value]
+        if using == 'accessibility id':
+            return snapshot.by_content_desc.get(value, [])
+        if using == AppiumBy.ANDROID_UIAUTOMATOR:
+            try:
+                selector = Selector.parse(value)
+            except ValueError:
+                return None
+            return [node for node in snapshot.nodes if selector.matches(node)]
+        return None
+
+    def __mean_seconds(self, command: str):
+        seconds = [entry['t'] for entry in self.trace.commands if entry['c'] == command]
+        return sum(seconds) / len(seconds) if seconds else 0.0
+
+    def __serve_synthetic(self, command: str, params: dict):
+        node = self.synthetic[params['id']]
+        if command == 'getElementText':
+            return {'value': node.text}
+        if command == 'getElementAttribute':
+            return {'value': node.attributes.get(params.get('name'))}
+        # Acting on a resolved element takes the place of the next recorded action
+        return self.__act(command, params, exact=False)
+
+    def __act(self, command: str, params: dict, exact=True):
+        action = self.segments[self.segment].action
+        if action is None:
+            return self.__diverged(f"{command} after the last recorded action")
+        if action['c'] != command or (exact and action['p'] != params):
+            self.divergences.append(
+                f"Segment {self.segment}: {command} replayed instead of the recorded {action['c']}")
+        self.segment += 1
+        self.replayed_seconds += action['t']
+        return action['r'] if action['c'] == command else {'value': None}
+
+    def report(self, elapsed_seconds: float):
+        """
+        Summarizes the replay
+
+        Args:
+            elapsed_seconds (float): The real time the replayed flow took
+
+        Returns:
+            dict: The round trips and time of the recording and of the replay
+        """
+        return {
+            "recorded_round_trips": len(self.trace.commands),
+            "replayed_round_trips": self.round_trips,
+            "recorded_round_trip_seconds": round(self.trace.recorded_seconds, 3),
+            "replayed_round_trip_seconds": round(self.replayed_seconds, 3),
+            # The waits of the flow are real, the round trips take their recorded time
+            "simulated_wall_seconds": round(
+                elapsed_seconds - self.serving_seconds + self.replayed_seconds, 3),
+            "actions_replayed": self.segment,
+            "actions_recorded": len(self.segments) - 1,
+            "divergences": self.divergences,
+        }
+
+
+class ReplayDriver(webdriver.Remote):
+    """
+    A webdriver running against a trace instead of an appium server
+    """
+
+    def __init__(self, trace: Trace):
+        super().__init__(ReplayExecutor(trace), options=UiAutomator2Options(),
+                         direct_connection=False)
+
+
+class ReplaySession:
+    """
+    An appium session replaying a trace
+    """
+
+    def __init__(self, driver: ReplayDriver):
+        self.driver = driver
+        self.lock = RLock()
+
+    def ensure_alive(self):
+        """
+        Checks the session like a real session, the check is part of the trace
+        """
+        self.driver.orientation
+        return self.driver
+
+    def stop(self):
+        """
+        Nothing to stop for a replayed session
+        """
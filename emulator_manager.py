@@ -0,0 +1,187 @@
+"""
+Module containing the lifecycle of the emulators, booted headless from a snapshot
+of the installed and logged in app and stopped while their account cools down
+"""
+
+import logging
+import os
+import re
+import subprocess
+import time
+from threading import Condition
+
+from async_adb import AdbError, AdbEventLoop
+from device_config import DeviceConfig
+
+EMULATOR_BINARY = os.environ.get('EMULATOR_BINARY', 'emulator')
+ADB_BINARY = os.environ.get('ADB_BINARY', 'adb')
+AVD_HOME = os.environ.get('ANDROID_AVD_HOME', os.path.expanduser('~/.android/avd'))
+# The snapshot with postcardcreator installed and the account logged in
+SNAPSHOT_NAME = os.environ.get('EMULATOR_SNAPSHOT', 'logged_in')
+BOOT_TIMEOUT = int(os.environ.get('EMULATOR_BOOT_TIMEOUT', 300))
+# Seconds before the slot of a parked device opens at which its emulator is booted
+BOOT_LEAD_TIME = int(os.environ.get('EMULATOR_BOOT_LEAD_TIME', 300))
+# Upper bound of emulators running at the same time, 0 for no bound
+MAX_RUNNING_EMULATORS = int(os.environ.get('MAX_RUNNING_EMULATORS', 0))
+
+EMULATOR_SERIAL_REGEX = re.compile(r'emulator-(\d+)')
+BOOT_POLL_INTERVAL = 2
+
+
+class EmulatorError(Exception):
+    """
+    Raised when an emulator does not boot, stop or save its snapshot
+    """
+
+
+class EmulatorSlots:
+    """
+    Counts the emulators running at the same time against their upper bound,
+    every emulator takes a slot before it boots and gives it back once it stopped
+    """
+
+    def __init__(self, limit: int = MAX_RUNNING_EMULATORS):
+        self.limit = limit
+        self.running = 0
+        self.condition = Condition()
+
+    def acquire(self, blocking=True):
+        """
+        Takes a slot for an emulator about to boot
+
+        Args:
+            blocking (bool): Whether to wait until another emulator stopped
+
+        Returns:
+            bool: Whether the slot was taken
+        """
+        with self.condition:
+            while self.limit and self.running >= self.limit:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.running += 1
+            return True
+
+    def release(self):
+        """
+        Gives back the slot of an emulator which stopped or failed to boot
+        """
+        with self.condition:
+            self.running = max(0, self.running - 1)
+            self.condition.notify()
+
+
+class Emulator:
+    """
+    A headless emulator running the avd of one device. The emulator is restored from
+    the snapshot without saving its state on exit, so every boot starts logged in
+    with the app installed.
+    """
+
+    def __init__(self, config: DeviceConfig, adb: AdbEventLoop = None):
+        match = EMULATOR_SERIAL_REGEX.fullmatch(config.adb_serial or '')
+        if match is None:
+            raise ValueError(
+                f"Device {config.name} runs the avd {config.avd} and needs an adb serial "
+                "like emulator-5554 for the port of the emulator")
+        self.name = config.name
+        self.avd = config.avd
+        self.serial = config.adb_serial
+        self.port = int(match.group(1))
+        self.adb = adb or AdbEventLoop.instance()
+        self.process = None
+
+    def has_snapshot(self):
+        """
+        Returns whether the avd has the snapshot of the logged in app
+        """
+        return os.path.isdir(os.path.join(AVD_HOME, f'{self.avd}.avd', 'snapshots', SNAPSHOT_NAME))
+
+    def is_booted(self):
+        """
+        Returns whether the emulator is connected over adb and finished booting
+        """
+        try:
+            if self.serial not in self.adb.run(self.adb.client.devices()):
+                return False
+            output = self.adb.run(self.adb.client.shell(self.serial, 'getprop sys.boot_completed'))
+        except (AdbError, OSError):
+            return False
+        return output.strip() == '1'
+
+    def boot(self):
+        """
+        Boots the emulator headless and waits until it finished booting,
+        an emulator which is already running is kept
+
+        Raises:
+            EmulatorError: If the emulator did not boot within the timeout
+        """
+        if self.is_booted():
+            return
+
+        snapshot = self.has_snapshot()
+        command = [EMULATOR_BINARY, '-avd', self.avd, '-port', str(self.port),
+                   '-no-window', '-no-audio', '-no-boot-anim', '-gpu', 'on']
+        if snapshot:
+            command += ['-snapshot', SNAPSHOT_NAME, '-no-snapshot-save']
+        else:
+            command += ['-no-snapshot-load']
+        logging.info("Booting emulator %s of device %s %s", self.avd, self.name,
+                     "from its snapshot" if snapshot else "cold, it has no snapshot yet")
+
+        started = time.monotonic()
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        while not self.is_booted():
+            if self.process.poll() is not None:
+                raise EmulatorError(
+                    f"Emulator {self.avd} exited with code {self.process.returncode}")
+            if time.monotonic() - started > BOOT_TIMEOUT:
+                self.stop()
+                raise EmulatorError(f"Emulator {self.avd} did not boot within {BOOT_TIMEOUT}s")
+            time.sleep(BOOT_POLL_INTERVAL)
+        logging.info("Emulator %s of device %s booted in %.1fs",
+                     self.avd, self.name, time.monotonic() - started)
+
+    def __console(self, *arguments: str):
+        result = subprocess.run([ADB_BINARY, '-s', self.serial, 'emu', *arguments],
+                                capture_output=True, text=True, timeout=BOOT_TIMEOUT)
+        if result.returncode != 0 or 'KO' in result.stdout:
+            raise EmulatorError(
+                f"Emulator command {' '.join(arguments)} failed: {result.stdout}{result.stderr}")
+        return result.stdout
+
+    def save_snapshot(self):
+        """
+        Saves the current state, with the app installed and logged in, as the snapshot
+        every later boot is restored from
+        """
+        self.__console('avd', 'snapshot', 'save', SNAPSHOT_NAME)
+        logging.info("Saved snapshot %s of emulator %s", SNAPSHOT_NAME, self.avd)
+
+    def stop(self):
+        """
+        Stops the emulator without saving its state
+        """
+        try:
+            self.__console('kill')
+        except (EmulatorError, subprocess.TimeoutExpired):
+            logging.warning("Emulator %s did not stop over its console", self.avd)
+            if self.process is None:
+                raise
+
+        if self.process is not None:
+            try:
+                self.process.wait(BOOT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        else:
+            # An emulator started by an earlier process can only be watched over adb
+            deadline = time.monotonic() + BOOT_TIMEOUT
+            while self.is_booted() and time.monotonic() < deadline:
+                time.sleep(BOOT_POLL_INTERVAL)
+        logging.info("Stopped emulator %s of device %s", self.avd, self.name)
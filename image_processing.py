@@ -0,0 +1,99 @@
+"""
+Module containing the preprocessing of images before they are sent to the devices
+"""
+
+import hashlib
+import io
+import os
+
+from PIL import Image, ImageOps
+
+from image_store import image_name
+
+# The postcard is printed in A6 (148mm x 105mm)
+CARD_WIDTH_MM = 148
+CARD_HEIGHT_MM = 105
+TARGET_DPI = int(os.environ.get('IMAGE_TARGET_DPI', 300))
+# Images below this resolution trigger the low resolution warning of the app
+MINIMUM_DPI = int(os.environ.get('IMAGE_MINIMUM_DPI', 150))
+JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 90))
+
+MM_PER_INCH = 25.4
+
+
+class LowResolutionError(ValueError):
+    """
+    Raised when an image has a too low resolution to be printed on a postcard
+    """
+
+
+class InvalidImageError(ValueError):
+    """
+    Raised when an upload is no image, is corrupt or decompresses to too many pixels
+    """
+
+
+def card_size(dpi: int, portrait: bool):
+    """
+    Returns the size of the postcard in pixels at the given resolution
+
+    Args:
+        dpi (int): The resolution in dots per inch
+        portrait (bool): Whether the card is in portrait orientation
+
+    Returns:
+        Tuple[int, int]: The width and height in pixels
+    """
+    long_side = round(CARD_WIDTH_MM / MM_PER_INCH * dpi)
+    short_side = round(CARD_HEIGHT_MM / MM_PER_INCH * dpi)
+    return (short_side, long_side) if portrait else (long_side, short_side)
+
+
+def preprocess_image(source: str, folder: str):
+    """
+    Orients the image according to its exif data, crops it to the aspect ratio of the card,
+    resizes it to the target resolution and stores it recompressed as jpeg.
+    Runs in a worker process, so all arguments and results are plain values.
+
+    Args:
+        source (str): The path of the original image
+        folder (str): The folder of the image store
+
+    Raises:
+        LowResolutionError: If the image is too small for the minimum resolution
+        InvalidImageError: If the file can not be read as an image
+
+    Returns:
+        str: The name of the processed image in the image store
+    """
+    try:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original)
+            portrait = image.height > image.width
+
+            minimum_size = card_size(MINIMUM_DPI, portrait)
+            if image.width < minimum_size[0] or image.height < minimum_size[1]:
+                raise LowResolutionError(
+                    f"The image has {image.width}x{image.height} pixels, "
+                    f"at least {minimum_size[0]}x{minimum_size[1]} are required")
+
+            # ImageOps.fit crops the center to the aspect ratio before resizing
+            image = ImageOps.fit(image.convert('RGB'), card_size(TARGET_DPI, portrait),
+                                 method=Image.LANCZOS)
+
+    except (Image.DecompressionBombError, OSError) as error:
+        # UnidentifiedImageError and truncated images are OSErrors
+        raise InvalidImageError(f"The upload is not a readable image: {error}") from error
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    content = buffer.getvalue()
+
+    name = image_name(hashlib.sha256(content).hexdigest(), 'postcard.jpg')
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+    return name
@@ -0,0 +1,220 @@
+"""
+Module containing the content addressed storage of the postcard images
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from threading import Lock
+from typing import List
+
+IMAGE_FOLDER = "images"
+DEVICE_IMAGES_FOLDER = "device_images"
+
+
+def image_name(digest: str, filename: str):
+    """
+    Returns the name an image is stored under, its hash and the extension of the original file
+
+    Args:
+        digest (str): The sha256 hex digest of the content
+        filename (str): The original file name
+    """
+    extension = os.path.splitext(filename)[1].lower() or '.jpg'
+    return f'{digest}{extension}'
+
+
+def write_atomically(path: str, content: str):
+    """
+    Replaces a file at once through a temporary file of its own,
+    so concurrent writers of the same file do not share a temporary file
+
+    Args:
+        path (str): The path of the file
+        content (str): The new content
+    """
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.write-', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+class ImageTooLargeError(Exception):
+    """
+    Raised when an uploaded image exceeds the maximum size
+    """
+
+
+class ImageUpload:
+    """
+    An image being written into the store chunk by chunk, hashing the data as it arrives
+    """
+
+    def __init__(self, store: 'ImageStore', max_size: int = None):
+        self.store = store
+        self.max_size = max_size
+        self.size = 0
+        self.digest = hashlib.sha256()
+        # The original is only kept in the store folder until it is processed
+        file_descriptor, self.temporary_path = tempfile.mkstemp(
+            dir=store.folder, prefix='.upload-', suffix='.tmp')
+        self.file = os.fdopen(file_descriptor, 'wb')
+
+    def write(self, chunk: bytes):
+        """
+        Appends a chunk to the image
+
+        Args:
+            chunk (bytes): The next chunk of the image
+        """
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ImageTooLargeError(
+                f"The image exceeds the maximum size of {self.max_size} bytes")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def close(self):
+        """
+        Finishes writing the image without moving it into the store
+
+        Returns:
+            str: The sha256 hex digest of the image
+        """
+        self.file.close()
+        return self.digest.hexdigest()
+
+    def abort(self):
+        """
+        Discards the partially written image
+        """
+        self.file.close()
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+
+class ImageStore:
+    """
+    A class storing images on the host under the sha256 of their content,
+    so the same image is only stored once
+    """
+
+    def __init__(self, folder=IMAGE_FOLDER):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name: str):
+        """
+        Returns the path of a stored image
+
+        Args:
+            name (str): The name of the image in the store
+        """
+        return os.path.join(self.folder, name)
+
+    def processed_name(self, original_digest: str):
+        """
+        Returns the name of the processed version of an original image if it was processed before
+
+        Args:
+            original_digest (str): The sha256 hex digest of the original image
+        """
+        try:
+            with open(self.path(f'{original_digest}.processed'), 'r', encoding='utf-8') as file:
+                name = file.read().strip()
+        except FileNotFoundError:
+            return None
+        return name if os.path.exists(self.path(name)) else None
+
+    def set_processed_name(self, original_digest: str, name: str):
+        """
+        Records the name of the processed version of an original image
+
+        Args:
+            original_digest (str): The sha256 hex digest of the original image
+            name (str): The name of the processed image in the store
+        """
+        write_atomically(self.path(f'{original_digest}.processed'), name)
+
+    def open_upload(self, max_size: int = None):
+        """
+        Starts writing an image into the store chunk by chunk
+
+        Args:
+            max_size (int, optional): The maximum size of the image in bytes
+
+        Returns:
+            ImageUpload: The upload to write the chunks to
+        """
+        return ImageUpload(self, max_size)
+
+
+class DeviceImageCache:
+    """
+    A record of the images present on one device, evicting the least recently used
+    images once more than the capacity are stored
+    """
+
+    def __init__(self, device_id: str, capacity: int = None, folder=DEVICE_IMAGES_FOLDER):
+        if capacity is None:
+            capacity = int(os.environ.get('DEVICE_IMAGE_CAPACITY', 10))
+        self.capacity = capacity
+        self.lock = Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f'{device_id}.json')
+
+        # Ordered from the least to the most recently used image
+        self.images: List[str] = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self.images = json.load(file)
+
+    def __save(self):
+        write_atomically(self.path, json.dumps(self.images))
+
+    def __contains__(self, name: str):
+        with self.lock:
+            return name in self.images
+
+    def touch(self, name: str):
+        """
+        Marks an image as present on the device and most recently used
+
+        Args:
+            name (str): The name of the image
+
+        Returns:
+            List[str]: The images evicted from the record which should be deleted on the device
+        """
+        with self.lock:
+            if name in self.images:
+                self.images.remove(name)
+            self.images.append(name)
+
+            evicted = self.images[:-self.capacity] if self.capacity > 0 else []
+            self.images = self.images[len(evicted):]
+            self.__save()
+
+        if evicted:
+            logging.info("Evicting images %s from the device", evicted)
+        return evicted
+
+    def discard(self, name: str):
+        """
+        Removes an image from the record, e.g. if it is missing on the device
+
+        Args:
+            name (str): The name of the image
+        """
+        with self.lock:
+            if name in self.images:
+                self.images.remove(name)
+                self.__save()
@@ -0,0 +1,182 @@
+"""
+Module containing the registry of all ui targets of the app, declared once and
+resolved either on the device as uiautomator selectors or locally in a snapshot
+"""
+
+import re
+from dataclasses import dataclass, replace
+from typing import Optional
+
+BUTTON_CLASS = "android.widget.Button"
+TEXT_CLASS = "android.widget.TextView"
+INPUT_FIELD_CLASS = "android.widget.EditText"
+SWITCH_CLASS = "android.widget.Switch"
+LAYOUT_CLASS = "android.widget.LinearLayout"
+
+# The methods of UiSelector the selectors compile to, by the field they filter
+SELECTOR_METHODS = {
+    'class_name': 'className',
+    'text': 'text',
+    'text_contains': 'textContains',
+    'description_contains': 'descriptionContains',
+    'resource_id': 'resourceId',
+}
+SELECTOR_METHOD_REGEX = re.compile(r'\.(\w+)\("((?:[^"\\]|\\.)*)"\)')
+
+
+def _quote(value: str):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _unquote(value: str):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+@dataclass(frozen=True)
+class Selector:
+    """
+    Dataclass for storing one way to identify a ui element, all given filters have to match
+    """
+    class_name: Optional[str] = None
+    text: Optional[str] = None
+    text_contains: Optional[str] = None
+    description_contains: Optional[str] = None
+    resource_id: Optional[str] = None
+
+    def uiautomator(self):
+        """
+        Compiles the selector to a uiautomator selector, evaluated on the device
+
+        Returns:
+            str: The selector for AppiumBy.ANDROID_UIAUTOMATOR
+        """
+        methods = ''.join(f'.{method}({_quote(getattr(self, name))})'
+                          for name, method in SELECTOR_METHODS.items()
+                          if getattr(self, name) is not None)
+        return f'new UiSelector(){methods}'
+
+    @classmethod
+    def parse(cls, uiautomator: str):
+        """
+        Parses a uiautomator selector compiled by this class
+
+        Raises:
+            ValueError: If the selector uses methods which are not supported
+
+        Returns:
+            Selector: The parsed selector
+        """
+        names = {method: name for name, method in SELECTOR_METHODS.items()}
+        values = {}
+        for method, value in SELECTOR_METHOD_REGEX.findall(uiautomator):
+            if method not in names:
+                raise ValueError(f"The selector method {method} is not supported")
+            values[names[method]] = _unquote(value)
+        return cls(**values)
+
+    def matches(self, node):
+        """
+        Returns whether a node of the ui, like a snapshot node, matches the selector
+        """
+        return ((self.class_name is None or node.class_name == self.class_name)
+                and (self.text is None or node.text == self.text)
+                and (self.text_contains is None or self.text_contains in node.text)
+                and (self.description_contains is None
+                     or self.description_contains in node.content_desc)
+                and (self.resource_id is None
+                     or getattr(node, 'resource_id', '') == self.resource_id))
+
+    def format(self, value: str):
+        """
+        Returns the selector with the placeholder of its filters replaced by the value
+        """
+        return replace(self, **{name: getattr(self, name).format(value)
+                                for name in SELECTOR_METHODS if getattr(self, name) is not None})
+
+
+class Locator:
+    """
+    A ui target with the selector identifying it
+    """
+
+    def __init__(self, name: str, selector: Selector):
+        self.name = name
+        self.selector = selector
+
+    def format(self, value: str):
+        """
+        Returns the locator for one value of a target like the image to pick
+
+        Args:
+            value (str): The value replacing the placeholder of the selector
+
+        Returns:
+            Locator: The locator of the value, sharing the name of the target
+        """
+        return Locator(self.name, self.selector.format(value))
+
+    def find(self, snapshot):
+        """
+        Returns the first node of a snapshot matching the selector
+
+        Args:
+            snapshot (UiSnapshot): The snapshot to search
+
+        Returns:
+            UiNode: The matching node or None
+        """
+        candidates = (snapshot.by_class.get(self.selector.class_name, [])
+                      if self.selector.class_name else snapshot.nodes)
+        for node in candidates:
+            if self.selector.matches(node):
+                return node
+        return None
+
+    def __repr__(self):
+        return f'Locator({self.name!r})'
+
+
+def _button(text):
+    return Locator(text, Selector(class_name=BUTTON_CLASS, text_contains=text))
+
+
+def _text(text):
+    return Locator(text, Selector(class_name=TEXT_CLASS, text_contains=text))
+
+
+# Login
+LOGIN_REGISTRATION = _button("Login / registration")
+LOGIN_WITH_SWISSID = _button("Login with SwissID")
+SWISSID_LOGIN = _text("Log in to Swiss Post")
+SWISSID_CONTINUE = _button("Continue")
+SWISSID_2FA = _text("Confirm with SwissID App")
+SWISSID_CANCELLED = _text("Cancelled")
+SWISSID_INCORRECT = _text("incorrect")
+CANCEL_LOGIN = _button("Cancel login")
+
+# Home
+CREATE_FREE_POSTCARD = _button("Create free postcard")
+CREATE_POSTCARD = _button("Create postcard")
+AVAILABLE_AGAIN = _button("Available again from")
+
+# Image
+SELECT_IMAGE = _button("Select image")
+ALLOW = _button("Allow")
+RECENT = _text("Recent")
+SHOW_ROOTS = Locator("Show roots", Selector(description_contains="Show roots"))
+DOWNLOADS = _text("Downloads")
+IMAGE = Locator("image", Selector(class_name=LAYOUT_CLASS, description_contains="{}"))
+LOW_RESOLUTION_OK = _button("OK")
+# The checkmark confirming the crop and the message, a glyph of the icon font
+CHECKMARK = Locator("N", Selector(class_name=TEXT_CLASS, text="N"))
+
+# Recipient and message
+RECIPIENT = _button("Recipient")
+SELECT_LOCATION = _text("Select location")
+LOCATION = Locator("location", Selector(class_name=TEXT_CLASS, text_contains="{}"))
+ENTER_MESSAGE = _button("Enter message")
+
+# Sending
+SEND = _button("Send it now for free")
+SENT_HOME = _button("Home")
+NEXT = _button("Next")
@@ -0,0 +1,32 @@
+"""
+Module containing the logging handlers referenced from log.ini
+"""
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+
+
+class QueueRotatingFileHandler(QueueHandler):
+    """
+    A rotating file handler writing on a background thread, so logging never blocks
+    the calling thread on disk io or on the rollover of the file
+    """
+
+    def __init__(self, filename, mode='a', maxBytes=DEFAULT_MAX_BYTES,
+                 backupCount=DEFAULT_BACKUP_COUNT, encoding='utf-8'):
+        super().__init__(Queue(-1))
+        # Records are formatted by this handler before they are queued
+        self.file_handler = RotatingFileHandler(filename, mode, maxBytes, backupCount,
+                                                encoding, delay=True)
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.file_handler.close()
+        super().close()
@@ -5,7 +5,8 @@ from time import sleep
 from dotenv import load_dotenv
 from adb_automations import ADBAutomationHandler
 
-from appium_automations import Postcard, Recipient
+from models import Postcard, Recipient
+from image_processing import preprocess_image
 from scheduler import PostcardScheduler
 
 # Load username and password from .env file
@@ -22,7 +23,7 @@ recipient = Recipient(
     postal_code="8755",
     location="Ennenda"
 )
-IMAGE_NAME = "IMG-20221026-WA0006.jpg"
+IMAGE_NAME = preprocess_image("images/IMG-20221026-WA0006.jpg", "images")
 
 scheduler = PostcardScheduler()
 
@@ -0,0 +1,165 @@
+"""
+Module containing the timing spans, counters and histograms exposed by the metrics endpoint
+"""
+
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Tuple
+
+# Upper bounds in seconds, from a single round trip up to a whole postcard flow
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    A histogram counting observations per bucket together with their count and sum
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """
+        Adds an observation to the histogram
+        """
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metrics:
+    """
+    A thread safe registry of counters, gauges and histograms keyed by name and labels,
+    rendered in the prometheus text format
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    @staticmethod
+    def __labels(labels: dict) -> Labels:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        """
+        Increments a counter
+
+        Args:
+            name (str): The name of the counter
+            amount (float): The amount to add
+        """
+        key = self.__labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """
+        Sets a gauge to its current value
+
+        Args:
+            name (str): The name of the gauge
+            value (float): The current value
+        """
+        with self.lock:
+            self.gauges.setdefault(name, {})[self.__labels(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Adds a duration to a histogram
+
+        Args:
+            name (str): The name of the histogram
+            seconds (float): The measured duration
+        """
+        key = self.__labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Measures the duration of the enclosed block into a histogram, also if it raises
+
+        Args:
+            name (str): The name of the histogram
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def render(self):
+        """
+        Returns all metrics in the prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines.extend(f'{name}{_format_labels(labels)} {value}'
+                                 for labels, value in sorted(series.items()))
+
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        cumulative += count
+                        lines.append(
+                            f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+                    lines.append(
+                        f'{name}_bucket{_format_labels(labels, le="+Inf")} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed(operation: str, device_attribute: str = 'device_id'):
+    """
+    Decorates a method of a device handler to measure its duration per device
+
+    Args:
+        operation (str): The name of the operation
+        device_attribute (str): The attribute of the handler holding the id of its device
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with metrics.span('automation_operation_seconds', operation=operation,
+                              device=getattr(self, device_attribute)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
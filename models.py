@@ -0,0 +1,60 @@
+"""
+Module containing the data models shared by the api, the queue and the automations
+"""
+
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+# Checkpoints of the postcard flow, recorded once a step is verified
+STEP_IMAGE = 'image'
+STEP_RECIPIENT = 'recipient'
+STEP_MESSAGE = 'message'
+STEP_TERMS = 'terms'
+STEP_SENT = 'sent'
+STEP_CONFIRMED = 'confirmed'
+# Once one of these steps was reached the postcard may have been sent and is never sent again
+SENDING_STEPS = frozenset({STEP_SENT, STEP_CONFIRMED})
+
+# @dataclass
+class Recipient(BaseModel):
+    """
+    Dataclass for storing the recipients information
+    """
+    first_name: str
+    last_name: str
+    address: str
+    postal_code: str
+    location: str
+
+
+# @dataclass
+class Postcard(BaseModel):
+    """
+    Dataclass for storing all metadata of a postcard
+    """
+    recipient: Recipient
+    image_location: str
+    description: str
+
+
+class SendOutcome(Enum):
+    """
+    The outcomes of an attempt to send a postcard
+    """
+    SENT = 'sent'
+    # The free postcard was not available, the attempt did not use the slot
+    UNAVAILABLE = 'unavailable'
+    # The attempt failed for a reason which may go away, e.g. a timeout or a crash of the app
+    RETRYABLE = 'retryable'
+    # The postcard can not be sent as it is or it may have been sent without a confirmation
+    PERMANENT = 'permanent'
+
+
+class SendResult(BaseModel):
+    """
+    Dataclass for storing the outcome of an attempt to send a postcard and the reason of a failure
+    """
+    outcome: SendOutcome
+    reason: Optional[str] = None
@@ -0,0 +1,144 @@
+"""
+Module containing the index of swiss postal codes and localities used to validate recipients
+"""
+
+import csv
+import logging
+import os
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from difflib import get_close_matches
+from typing import List
+
+DEFAULT_INDEX_FILE = os.path.join(os.path.dirname(__file__), 'data', 'plz.tsv')
+MAX_SUGGESTIONS = 5
+
+
+class InvalidRecipientError(ValueError):
+    """
+    Raised when the postal code and location of a recipient do not combine
+    """
+
+    def __init__(self, message: str, suggestions: List[str]):
+        super().__init__(message)
+        self.suggestions = suggestions
+
+
+def normalize_locality(locality: str):
+    """
+    Returns the locality in a form for comparisons, without case, accents and punctuation
+
+    Args:
+        locality (str): The name of the locality
+    """
+    decomposed = unicodedata.normalize('NFKD', locality.casefold())
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.replace('.', ' ').replace('-', ' ').split())
+
+
+class PostalCodeIndex:
+    """
+    A sorted array of postal codes with their localities, as shown in the location picker of the app
+    """
+
+    def __init__(self, entries):
+        entries = sorted(set(entries), key=lambda entry: (int(entry[0]), entry[1]))
+        self.codes = array('I', (int(code) for code, _ in entries))
+        self.localities = [locality for _, locality in entries]
+        self.codes_by_locality = {}
+        for code, locality in entries:
+            self.codes_by_locality.setdefault(normalize_locality(locality), []).append(code)
+
+    @classmethod
+    def load(cls, path: str = None):
+        """
+        Loads the index from a tab separated file of postal codes and localities
+
+        Args:
+            path (str, optional): The path of the file, defaults to $POSTAL_CODE_INDEX or data/plz.tsv
+
+        Returns:
+            PostalCodeIndex: The index or None if the file does not exist
+        """
+        path = path or os.environ.get('POSTAL_CODE_INDEX', DEFAULT_INDEX_FILE)
+        if not os.path.isfile(path):
+            logging.warning("No postal code index at %s, recipients are NOT validated. "
+                            "Build it with `python3 postal_codes.py plz_verzeichnis_v2.csv` "
+                            "from the postal code directory of Swiss Post", path)
+            return None
+
+        with open(path, 'r', encoding='utf-8') as file:
+            entries = [tuple(line.rstrip('\n').split('\t', 1)) for line in file if line.strip()]
+        logging.info("Loaded %s postal codes from %s", len(entries), path)
+        return cls(entries)
+
+    def localities_for(self, postal_code: str):
+        """
+        Returns all localities of a postal code
+
+        Args:
+            postal_code (str): The postal code
+        """
+        if not postal_code.strip().isdigit():
+            return []
+        code = int(postal_code)
+        return self.localities[bisect_left(self.codes, code):bisect_right(self.codes, code)]
+
+    def validate(self, postal_code: str, location: str):
+        """
+        Checks that the location belongs to the postal code
+
+        Args:
+            postal_code (str): The postal code of the recipient
+            location (str): The location of the recipient
+
+        Raises:
+            InvalidRecipientError: If they do not combine, with suggestions for the location
+
+        Returns:
+            str: The location exactly as it is shown in the location picker of the app
+        """
+        localities = self.localities_for(postal_code)
+        normalized = normalize_locality(location)
+
+        for locality in localities:
+            if normalize_locality(locality) == normalized:
+                return locality
+
+        if not localities:
+            codes = self.codes_by_locality.get(normalized, [])
+            raise InvalidRecipientError(
+                f"The postal code {postal_code} does not exist",
+                [f"{code} {location}" for code in codes[:MAX_SUGGESTIONS]])
+
+        by_normalized = {normalize_locality(locality): locality for locality in localities}
+        matches = get_close_matches(normalized, by_normalized, n=MAX_SUGGESTIONS, cutoff=0.6)
+        raise InvalidRecipientError(
+            f"The location {location} and postal code {postal_code} do not combine",
+            [by_normalized[match] for match in matches] or localities[:MAX_SUGGESTIONS])
+
+
+def build_index(source: str, destination: str = DEFAULT_INDEX_FILE,
+                code_column='POSTLEITZAHL', locality_column='ORTBEZ27'):
+    """
+    Builds the index file from the postal code directory published by Swiss Post
+    (semicolon separated csv)
+
+    Args:
+        source (str): The path of the csv file
+        destination (str): The path of the index file to write
+    """
+    with open(source, 'r', encoding='utf-8-sig') as file:
+        entries = {(row[code_column].strip(), row[locality_column].strip())
+                   for row in csv.DictReader(file, delimiter=';')}
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(destination, 'w', encoding='utf-8') as file:
+        for code, locality in sorted(entries, key=lambda entry: (int(entry[0]), entry[1])):
+            file.write(f'{code}\t{locality}\n')
+
+
+if __name__ == "__main__":
+    build_index(sys.argv[1])
@@ -0,0 +1,99 @@
+"""
+Module containing the fan out of postcard state changes to the clients subscribed to them
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Set, Tuple
+
+# Statuses buffered per subscriber, a slow client only misses statuses it would collapse anyway
+SUBSCRIBER_BUFFER = 100
+
+
+def _offer(queue: asyncio.Queue, event: dict):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+class PostcardEvents:
+    """
+    A broker delivering the status of postcards to the asyncio queues of the subscribed clients
+    whenever the queue changed. The statuses of all subscribed postcards are computed once
+    per change on the broadcasting thread, changes published meanwhile are collapsed,
+    so the cost of a change does not grow with the number of clients.
+    """
+
+    def __init__(self, statuses: Callable[[List[int]], Dict[int, dict]]):
+        """
+        Args:
+            statuses (Callable[[List[int]], Dict[int, dict]]): Computes the status of
+                several postcards at once, keyed by their ids
+        """
+        self.statuses = statuses
+        self.lock = Lock()
+        self.subscribers: Dict[int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = \
+            defaultdict(set)
+        self.changed = Event()
+        self.broadcast_thread = Thread(target=self.__broadcast, name='postcard-events', daemon=True)
+        self.broadcast_thread.start()
+
+    def subscribe(self, postcard_id: int):
+        """
+        Subscribes to the changes of a postcard, must be called on the event loop of the client
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            asyncio.Queue: The queue receiving the statuses
+        """
+        queue = asyncio.Queue(SUBSCRIBER_BUFFER)
+        with self.lock:
+            self.subscribers[postcard_id].add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, postcard_id: int, queue: asyncio.Queue):
+        """
+        Removes a subscription once its client is gone
+        """
+        with self.lock:
+            subscribers = self.subscribers.get(postcard_id, set())
+            subscribers.difference_update(
+                {subscriber for subscriber in subscribers if subscriber[1] is queue})
+            if not subscribers:
+                self.subscribers.pop(postcard_id, None)
+
+    def publish(self, postcard_ids: List[int], state: str):
+        """
+        Publishes a change of the queue, safe to call from any thread.
+        Any change may move the position of every queued postcard, so the statuses of all
+        subscribed postcards are broadcast.
+
+        Args:
+            postcard_ids (List[int]): The postcards which changed
+            state (str): Their new state
+        """
+        self.changed.set()
+
+    def __broadcast(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            with self.lock:
+                subscribers = [(postcard_id, subscriber)
+                               for postcard_id, group in self.subscribers.items()
+                               for subscriber in group]
+            if not subscribers:
+                continue
+
+            try:
+                statuses = self.statuses(list({postcard_id for postcard_id, _ in subscribers}))
+            except Exception:
+                logging.exception("Failed to compute the status of the subscribed postcards")
+                continue
+            for postcard_id, (loop, queue) in subscribers:
+                if postcard_id in statuses:
+                    loop.call_soon_threadsafe(_offer, queue, statuses[postcard_id])
@@ -0,0 +1,412 @@
+"""
+Module containing the persistent queue storing the postcards waiting to be sent
+"""
+
+import logging
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from threading import Lock
+from typing import List, Optional, Set
+
+from models import Postcard
+
+QUEUED = 'queued'
+IN_FLIGHT = 'in_flight'
+SENT = 'sent'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+DEFAULT_QUEUE_FILE = 'postcards.sqlite3'
+
+# Retried postcards go back to the head of the postcards of their priority
+QUEUE_ORDER = 'priority DESC, attempts > 0 DESC, deadline IS NULL, deadline, id'
+
+
+@dataclass
+class QueuedPostcard:
+    """
+    Dataclass for storing a postcard taken from the queue together with its id
+    """
+    postcard_id: int
+    postcard: Postcard
+
+
+class PersistentPostcardQueue:
+    """
+    A crash safe postcard queue backed by sqlite in WAL mode.
+    Postcards which were in flight during a crash are delivered exactly once more.
+    Every change of state is reported to the optional on_change callback with the ids
+    of the changed postcards and their new state.
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE_FILE, on_change=None):
+        self.path = path
+        self.lock = Lock()
+        self.on_change = on_change or (lambda postcard_ids, state: None)
+
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS postcards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                postcard TEXT NOT NULL,
+                state TEXT NOT NULL,
+                redelivered INTEGER NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0,
+                deadline TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )""")
+        self.__migrate()
+        # Only pending postcards are indexed, so a restart costs O(pending). sqlite only
+        # uses a partial index for queries repeating its condition literally, so the
+        # queries below inline the state instead of binding it.
+        self.connection.execute('DROP INDEX IF EXISTS pending_postcards')
+        self.connection.execute('DROP INDEX IF EXISTS pending_postcards_by_priority')
+        self.connection.execute(f"""
+            CREATE INDEX IF NOT EXISTS queued_postcards ON postcards ({QUEUE_ORDER})
+            WHERE state = '{QUEUED}'""")
+        self.connection.execute(f"""
+            CREATE INDEX IF NOT EXISTS in_flight_postcards ON postcards (redelivered)
+            WHERE state = '{IN_FLIGHT}'""")
+        # The steps of the send flow completed per postcard, so a retry resumes after them
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                postcard_id INTEGER NOT NULL REFERENCES postcards (id),
+                step TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (postcard_id, step)
+            )""")
+
+        self.__recover_in_flight()
+
+    def __migrate(self):
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(postcards)')}
+        if 'priority' not in columns:
+            self.connection.execute(
+                'ALTER TABLE postcards ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+        if 'deadline' not in columns:
+            self.connection.execute('ALTER TABLE postcards ADD COLUMN deadline TEXT')
+        if 'attempts' not in columns:
+            self.connection.execute(
+                'ALTER TABLE postcards ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        if 'error' not in columns:
+            self.connection.execute('ALTER TABLE postcards ADD COLUMN error TEXT')
+
+    def __recover_in_flight(self):
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            # Postcards already redelivered once are not retried again
+            abandoned = self.connection.execute(
+                "UPDATE postcards SET state = ?, error = ?, updated_at = ? "
+                f"WHERE state = '{IN_FLIGHT}' AND redelivered = 1",
+                (FAILED, "Interrupted by a crash twice", now)).rowcount
+            recovered = self.connection.execute(
+                "UPDATE postcards SET state = ?, redelivered = 1, updated_at = ? "
+                f"WHERE state = '{IN_FLIGHT}'",
+                (QUEUED, now)).rowcount
+            self.connection.execute('COMMIT')
+
+        if recovered or abandoned:
+            logging.warning(
+                "Recovered %s postcards in flight during a crash, %s were already redelivered",
+                recovered, abandoned)
+        logging.info("Postcard queue loaded with %s pending postcards", self.qsize())
+
+    def __insert(self, postcard: Postcard, priority: int, deadline: Optional[datetime], now: str):
+        return self.connection.execute(
+            "INSERT INTO postcards (postcard, state, priority, deadline, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (postcard.json(), QUEUED, priority,
+             deadline.isoformat() if deadline else None, now, now)).lastrowid
+
+    def put(self, postcard: Postcard, priority: int = 0, deadline: datetime = None):
+        """
+        Adds a postcard to the queue
+
+        Args:
+            postcard (Postcard): The postcard to append
+            priority (int): Postcards with a higher priority are taken first
+            deadline (datetime, optional): Postcards of the same priority are taken by deadline
+
+        Returns:
+            int: The id of the stored postcard
+        """
+        now = datetime.now().isoformat()
+        with self.lock:
+            postcard_id = self.__insert(postcard, priority, deadline, now)
+        self.on_change([postcard_id], QUEUED)
+        return postcard_id
+
+    def put_many(self, postcards: List[Postcard], priority: int = 0, deadline: datetime = None):
+        """
+        Adds several postcards to the queue in a single transaction,
+        either all or none of them are queued
+
+        Args:
+            postcards (List[Postcard]): The postcards to append
+            priority (int): Postcards with a higher priority are taken first
+            deadline (datetime, optional): Postcards of the same priority are taken by deadline
+
+        Returns:
+            List[int]: The ids of the stored postcards in the same order
+        """
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                postcard_ids = [self.__insert(postcard, priority, deadline, now)
+                                for postcard in postcards]
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        self.on_change(postcard_ids, QUEUED)
+        return postcard_ids
+
+    def peek(self, offset: int = 0):
+        """
+        Returns a queued postcard without taking it from the queue
+
+        Args:
+            offset (int): The position of the postcard, 0 is the next postcard to be taken
+
+        Returns:
+            QueuedPostcard: The postcard with its id or None if the queue is shorter
+        """
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT id, postcard FROM postcards WHERE state = '{QUEUED}' "
+                f"ORDER BY {QUEUE_ORDER} LIMIT 1 OFFSET ?",
+                (offset,)).fetchone()
+        if row is None:
+            return None
+        return QueuedPostcard(postcard_id=row[0], postcard=Postcard.parse_raw(row[1]))
+
+    def get_nowait(self):
+        """
+        Takes the next postcard and marks it as in flight. Postcards are ordered by
+        priority, then retried postcards first, then by deadline, then by the time they were queued.
+
+        Returns:
+            QueuedPostcard: The postcard with its id or None if the queue is empty
+        """
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT id, postcard FROM postcards WHERE state = '{QUEUED}' "
+                f"ORDER BY {QUEUE_ORDER} LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute(
+                "UPDATE postcards SET state = ?, updated_at = ? WHERE id = ?",
+                (IN_FLIGHT, datetime.now().isoformat(), row[0]))
+
+        self.on_change([row[0]], IN_FLIGHT)
+        return QueuedPostcard(postcard_id=row[0], postcard=Postcard.parse_raw(row[1]))
+
+    def cancel(self, postcard_id: int):
+        """
+        Cancels a postcard which is still waiting in the queue
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            bool: Whether the postcard was cancelled
+        """
+        with self.lock:
+            cancelled = self.connection.execute(
+                "UPDATE postcards SET state = ?, updated_at = ? WHERE id = ? AND state = ?",
+                (CANCELLED, datetime.now().isoformat(), postcard_id, QUEUED)).rowcount == 1
+        if cancelled:
+            self.on_change([postcard_id], CANCELLED)
+        return cancelled
+
+    def __set_state(self, postcard_id: int, state: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE postcards SET state = ?, updated_at = ? WHERE id = ?",
+                (state, datetime.now().isoformat(), postcard_id))
+        self.on_change([postcard_id], state)
+
+    def mark_sent(self, postcard_id: int):
+        """
+        Marks an in flight postcard as sent
+
+        Args:
+            postcard_id (int): The id of the postcard
+        """
+        self.__set_state(postcard_id, SENT)
+
+    def mark_failed(self, postcard_id: int, error: str = None):
+        """
+        Marks an in flight postcard as failed, moving it to the dead letters
+
+        Args:
+            postcard_id (int): The id of the postcard
+            error (str, optional): The reason of the failure
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE postcards SET state = ?, error = ?, updated_at = ? WHERE id = ?",
+                (FAILED, error, datetime.now().isoformat(), postcard_id))
+        self.on_change([postcard_id], FAILED)
+
+    def requeue(self, postcard_id: int, error: str, max_attempts: int, count_attempt=True):
+        """
+        Puts an in flight postcard back to the head of the queue,
+        or marks it as failed once it used up its attempts
+
+        Args:
+            postcard_id (int): The id of the postcard
+            error (str): The reason of the failed attempt
+            max_attempts (int): The number of attempts before the postcard is given up
+            count_attempt (bool): Whether the attempt counts, e.g. not if the slot was not open
+
+        Returns:
+            bool: Whether the postcard was queued again
+        """
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                attempts = self.connection.execute(
+                    "SELECT attempts FROM postcards WHERE id = ?", (postcard_id,)).fetchone()[0]
+                attempts += 1 if count_attempt else 0
+                state = QUEUED if attempts < max_attempts else FAILED
+                self.connection.execute(
+                    "UPDATE postcards SET state = ?, attempts = ?, error = ?, updated_at = ? "
+                    "WHERE id = ?", (state, attempts, error, now, postcard_id))
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        self.on_change([postcard_id], state)
+        return state == QUEUED
+
+    def dead_letters(self, limit: int = 100):
+        """
+        Returns the postcards which failed permanently, the most recent first
+
+        Args:
+            limit (int): The maximum number of postcards returned
+
+        Returns:
+            List[dict]: The id, postcard, error, attempts and time of failure of each postcard
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, postcard, error, attempts, updated_at FROM postcards "
+                "WHERE state = ? ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (FAILED, limit)).fetchall()
+        return [{"id": row[0], "postcard": Postcard.parse_raw(row[1]), "error": row[2],
+                 "attempts": row[3], "failed_at": row[4]} for row in rows]
+
+    def statuses(self, postcard_ids: List[int]):
+        """
+        Returns the states of several postcards, looked up by their primary keys.
+        Queued postcards also get their position, found in a single pass over the
+        index of queued postcards which stops at the last of them.
+
+        Args:
+            postcard_ids (List[int]): The ids of the postcards
+
+        Returns:
+            Dict[int, dict]: The status of every existing postcard with its position, keyed by its id
+        """
+        if not postcard_ids:
+            return {}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, state, attempts, error, created_at, updated_at FROM postcards "
+                f"WHERE id IN ({', '.join('?' * len(postcard_ids))})", list(postcard_ids)).fetchall()
+            statuses = {row[0]: {"id": row[0], "state": row[1], "attempts": row[2],
+                                 "error": row[3], "created_at": row[4], "updated_at": row[5],
+                                 "position": None} for row in rows}
+
+            waiting = {postcard_id for postcard_id, status in statuses.items()
+                       if status["state"] == QUEUED}
+            if waiting:
+                cursor = self.connection.execute(
+                    f"SELECT id FROM postcards WHERE state = '{QUEUED}' ORDER BY {QUEUE_ORDER}")
+                for position, (postcard_id,) in enumerate(cursor):
+                    if postcard_id in waiting:
+                        statuses[postcard_id]["position"] = position
+                        waiting.discard(postcard_id)
+                        if not waiting:
+                            break
+        return statuses
+
+    def status(self, postcard_id: int):
+        """
+        Returns the state of a postcard and its position if it is queued
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            dict: The status of the postcard or None if there is no such postcard
+        """
+        return self.statuses([postcard_id]).get(postcard_id)
+
+    def checkpoints(self, postcard_id: int):
+        """
+        Returns the steps of the send flow completed for a postcard
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            Set[str]: The completed steps
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT step FROM checkpoints WHERE postcard_id = ?", (postcard_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def save_checkpoints(self, postcard_id: int, steps: Set[str]):
+        """
+        Replaces the completed steps of a postcard in a single transaction
+
+        Args:
+            postcard_id (int): The id of the postcard
+            steps (Set[str]): All steps completed so far
+        """
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    "DELETE FROM checkpoints WHERE postcard_id = ? AND step NOT IN "
+                    f"({', '.join('?' * len(steps))})", (postcard_id, *steps))
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO checkpoints (postcard_id, step, created_at) "
+                    "VALUES (?, ?, ?)", [(postcard_id, step, now) for step in steps])
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def qsize(self):
+        """
+        Returns the number of postcards waiting in the queue
+
+        Returns:
+            int: The number of queued postcards
+        """
+        with self.lock:
+            return self.connection.execute(
+                f"SELECT COUNT(*) FROM postcards WHERE state = '{QUEUED}'").fetchone()[0]
+
+    def empty(self):
+        """
+        Returns whether there are no postcards waiting in the queue
+        """
+        return self.qsize() == 0
@@ -0,0 +1,57 @@
+"""
+Module replaying a recorded trace through the current automations, without a device
+
+    python3 replay.py traces/emulator-5554-send_free_postcard-20240101-120000.trace.gz
+"""
+
+import argparse
+import json
+import time
+
+from appium_automations import LOOKUP_ELEMENTS, LOOKUP_SNAPSHOT, AppiumAutomationHandler
+from driver_trace import REDACTED, ReplayDriver, ReplaySession, Trace
+from models import Postcard
+
+
+def replay(path: str, lookup_mode: str = None):
+    """
+    Runs the recorded flow of a trace again against the recorded responses
+
+    Args:
+        path (str): The path of the trace
+        lookup_mode (str, optional): The lookup mode of the replayed flow
+
+    Returns:
+        dict: The result of the flow and the report of the replay
+    """
+    trace = Trace.load(path)
+    flow, arguments = trace.header['flow'], trace.header['arguments']
+    driver = ReplayDriver(trace)
+    handler = AppiumAutomationHandler(
+        trace.header['device'], session=ReplaySession(driver), lookup_mode=lookup_mode,
+        swissid_username=arguments.get('swissid_username'), swissid_password=REDACTED)
+
+    started = time.perf_counter()
+    if flow == 'send_free_postcard':
+        result = handler.send_free_postcard(Postcard.parse_obj(arguments['postcard']),
+                                            set(arguments['progress']))
+    elif flow == 'login_with_swissid':
+        result = handler.login_with_swissid()
+    else:
+        raise ValueError(f"Can not replay the unknown flow {flow}")
+    elapsed = time.perf_counter() - started
+
+    return {"flow": flow, "result": result, **driver.command_executor.report(elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trace', help="the trace file to replay")
+    parser.add_argument('--lookup-mode', choices=(LOOKUP_ELEMENTS, LOOKUP_SNAPSHOT))
+    arguments = parser.parse_args()
+
+    print(json.dumps(replay(arguments.trace, arguments.lookup_mode), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,798 @@
+import heapq
+import itertools
 import logging
+import os
 from datetime import datetime, timedelta
 from queue import Queue
-from threading import Thread
-from time import sleep
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter
+from typing import Callable, List
 
-from appium_automations import Postcard
-from automation_handler import AutomationHandler
+from device_config import (PHASE_BOOTING, PHASE_FAILED, PHASE_PARKED, PHASE_PENDING,
+                           PHASE_READY, DeviceConfig, load_device_configs)
+from emulator_manager import (BOOT_LEAD_TIME, MAX_RUNNING_EMULATORS, Emulator, EmulatorError,
+                              EmulatorSlots)
+from metrics import metrics
+from models import SENDING_STEPS, Postcard, SendOutcome, SendResult
+from postcard_queue import (DEFAULT_QUEUE_FILE, IN_FLIGHT, QUEUED, PersistentPostcardQueue,
+                            QueuedPostcard)
+
+POSTCARD_COOLDOWN = 86400
+# Attempts per postcard before it is moved to the dead letters
+MAX_SEND_ATTEMPTS = int(os.environ.get('MAX_SEND_ATTEMPTS', 3))
+# Seconds between two checks which emulators to boot or stop
+AUTOSCALE_INTERVAL = 30
+# Seconds a send is assumed to take until a device measured its own
+DEFAULT_SEND_SECONDS = 60
+# Seconds assumed until the slot of a device opens when its cooldown could not be read
+UNKNOWN_COOLDOWN_SECONDS = 300
+# Weight of the latest send in the moving average of the send duration
+SEND_SECONDS_WEIGHT = 0.3
+
+# Tasks handed to the workers
+SEND = 'send'
+PREPARE = 'prepare'
+PARK = 'park'
+WAKE = 'wake'
+
+
+class PostcardWorker:
+    """
+    A worker owning one device and account which sends the postcards handed to it.
+    Only the worker thread drives the device, other threads read the published cooldown.
+    A worker with an emulator can be parked, stopping the emulator until its next slot.
+    """
+
+    def __init__(self, device_config: DeviceConfig, queue: PersistentPostcardQueue,
+                 on_available: Callable[['PostcardWorker'], None],
+                 on_phase: Callable[[str], None] = None, automation_factory=None,
+                 emulator: Emulator = None, emulator_slots: EmulatorSlots = None):
+        if automation_factory is None:
+            # Imported here so appium and selenium are only loaded once a device is brought up
+            from automation_handler import AutomationHandler
+            automation_factory = AutomationHandler
+
+        self.name = device_config.name
+        self.device_config = device_config
+        self.on_phase = on_phase or (lambda phase: None)
+        self.automation_factory = automation_factory
+        self.automation_handler = automation_factory(device_config, on_phase)
+        self.emulator = emulator
+        # The running emulators shared by all workers, a running emulator holds a slot
+        self.emulator_slots = emulator_slots or EmulatorSlots(limit=0)
+        # Whether the worker was asked to park and whether its emulator is stopped
+        self.parking = False
+        self.parked = False
+        self.queue = queue
+        self.on_available = on_available
+        self.inbox = Queue()
+        # The id of the postcard prepared during the current cooldown
+        self.staged_postcard_id = None
+        self.worker_thread = Thread(target=self.__start, name=self.name)
+
+        self.state_lock = Lock()
+        self.available_at = self.automation_handler.updated_timestamp + \
+            timedelta(seconds=self.automation_handler.time_remaining)
+        self.send_seconds = DEFAULT_SEND_SECONDS
+
+    def start(self):
+        """
+        Starts the thread of the worker and announces its first slot
+        """
+        self.worker_thread.start()
+        self.on_available(self)
+
+    def stop(self):
+        """
+        Stops the thread of the worker once the current postcard is sent
+        """
+        self.inbox.put(None)
+
+    def send(self, queued: QueuedPostcard):
+        """
+        Hands a postcard to the worker to be sent on its thread
+
+        Args:
+            queued (QueuedPostcard): The postcard taken from the queue
+        """
+        self.staged_postcard_id = None
+        self.inbox.put((SEND, queued))
+
+    def prepare(self, queued: QueuedPostcard):
+        """
+        Hands a postcard to the worker to be prepared on its thread during the cooldown,
+        the postcard stays in the queue
+
+        Args:
+            queued (QueuedPostcard): The postcard expected to be sent next by this worker
+        """
+        self.staged_postcard_id = queued.postcard_id
+        self.inbox.put((PREPARE, queued))
+
+    def park(self):
+        """
+        Stops the emulator of the worker until its next slot, once the worker is idle
+        """
+        self.parking = True
+        self.inbox.put((PARK, None))
+
+    def wake(self):
+        """
+        Boots the emulator of the parked worker ahead of its next slot
+        """
+        self.parking = False
+        self.inbox.put((WAKE, None))
+
+    def is_parked(self):
+        """
+        Returns whether the worker is parked or about to be parked
+        """
+        return self.parking
+
+    def get_available_at(self):
+        """
+        Returns the time this worker is able to send a new postcard again,
+        as last published by the worker without touching the device
+        """
+        with self.state_lock:
+            return self.available_at
+
+    def get_send_seconds(self):
+        """
+        Returns the moving average of the time this worker takes to send a postcard
+        """
+        with self.state_lock:
+            return self.send_seconds
+
+    def get_timeout_seconds(self):
+        """
+        Returns the time remaining before this worker is able to send a new postcard
+
+        Returns:
+            int: the number of seconds as integer
+        """
+        return max(0, int((self.get_available_at() - datetime.now()).total_seconds()))
+
+    def __refresh_available_at(self, fallback_seconds: int = UNKNOWN_COOLDOWN_SECONDS):
+        try:
+            time_remaining = self.automation_handler.get_timeout_seconds()
+        except Exception:
+            logging.exception("Worker %s failed to read its cooldown, assuming %s seconds",
+                              self.name, fallback_seconds)
+            time_remaining = fallback_seconds
+        with self.state_lock:
+            self.available_at = datetime.now() + timedelta(seconds=time_remaining)
+
+    def __send(self, queued: QueuedPostcard):
+        """
+        Sends a postcard and moves it to its next state in the queue
+
+        Returns:
+            SendOutcome: The outcome of the attempt
+        """
+        postcard_to_be_sent = queued.postcard
+
+        logging.info("Worker %s sending postcard %s with description %s",
+                     self.name, queued.postcard_id, postcard_to_be_sent.description)
+
+        checkpoints = self.queue.checkpoints(queued.postcard_id)
+        started = perf_counter()
+        try:
+            with metrics.span('postcard_send_seconds', device=self.name):
+                result = self.automation_handler.send_postcard(
+                    postcard_to_be_sent, checkpoints,
+                    lambda steps: self.queue.save_checkpoints(queued.postcard_id, steps))
+        except Exception as error:
+            logging.exception("Worker %s crashed while sending postcard %s",
+                              self.name, queued.postcard_id)
+            if checkpoints & SENDING_STEPS:
+                # The postcard may have been sent, so it is never sent again
+                result = SendResult(
+                    outcome=SendOutcome.PERMANENT,
+                    reason=f"Sending failed after pressing send, check the app before retrying: {error}")
+            else:
+                result = SendResult(outcome=SendOutcome.RETRYABLE, reason=str(error))
+        metrics.increment('postcard_outcomes_total', device=self.name,
+                          outcome=result.outcome.value)
+
+        if result.outcome == SendOutcome.SENT:
+            with self.state_lock:
+                self.send_seconds += SEND_SECONDS_WEIGHT * \
+                    (perf_counter() - started - self.send_seconds)
+            self.queue.mark_sent(queued.postcard_id)
+            logging.info("Worker %s sent postcard %s", self.name, queued.postcard_id)
+        elif result.outcome == SendOutcome.PERMANENT:
+            logging.error("Worker %s failed to send postcard %s permanently: %s",
+                          self.name, queued.postcard_id, result.reason)
+            self.queue.mark_failed(queued.postcard_id, result.reason)
+        elif self.queue.requeue(queued.postcard_id, result.reason, MAX_SEND_ATTEMPTS,
+                                count_attempt=result.outcome == SendOutcome.RETRYABLE):
+            # The slot of this worker is usually still open, so the retry follows right away
+            logging.warning("Worker %s failed to send postcard %s, queued it again: %s",
+                            self.name, queued.postcard_id, result.reason)
+        else:
+            logging.error("Worker %s gave up postcard %s after %s attempts: %s",
+                          self.name, queued.postcard_id, MAX_SEND_ATTEMPTS, result.reason)
+        return result.outcome
+
+    def __prepare(self, queued: QueuedPostcard):
+        if not self.automation_handler.prepare_postcard(queued.postcard):
+            logging.warning("Worker %s failed to prepare postcard %s",
+                            self.name, queued.postcard_id)
+
+    def __park(self):
+        if self.parked or not self.parking:
+            # Woken up again before the worker got to park
+            return
+        self.automation_handler.close()
+        try:
+            self.emulator.stop()
+        except (EmulatorError, OSError):
+            logging.exception("Worker %s failed to stop its emulator, it keeps running", self.name)
+            self.parking = False
+            return
+        self.emulator_slots.release()
+        self.parked = True
+        # The snapshot is restored on the next boot, so the staged image is gone
+        self.staged_postcard_id = None
+        self.on_phase(PHASE_PARKED)
+
+    def __abort_wake(self):
+        try:
+            self.emulator.stop()
+        except (EmulatorError, OSError):
+            # The emulator keeps its slot while it may still be running
+            logging.exception("Worker %s failed to stop its emulator", self.name)
+        else:
+            self.emulator_slots.release()
+        # Still parked, so the autoscaler tries to wake it up again
+        self.parking = True
+        self.on_phase(PHASE_PARKED)
+
+    def __wake(self):
+        """
+        Boots the emulator of a parked worker and connects to it again,
+        unless the bound of running emulators is reached
+
+        Returns:
+            bool: Whether the device is ready to send
+        """
+        if not self.parked:
+            return True
+        if not self.emulator_slots.acquire(blocking=False):
+            logging.info("Worker %s stays parked until another emulator is stopped", self.name)
+            self.parking = True
+            return False
+
+        self.on_phase(PHASE_BOOTING)
+        try:
+            self.emulator.boot()
+            automation_handler = self.automation_factory(self.device_config, self.on_phase)
+        except Exception:
+            logging.exception("Worker %s failed to wake up its device", self.name)
+            self.__abort_wake()
+            return False
+
+        if not automation_handler.logged_in:
+            logging.error("Worker %s is not logged in after waking up", self.name)
+            automation_handler.close()
+            self.__abort_wake()
+            return False
+        if automation_handler.login_required:
+            # The account was logged out in the snapshot, the fresh login is kept for next time
+            try:
+                self.emulator.save_snapshot()
+            except (EmulatorError, OSError):
+                logging.exception("Worker %s failed to save its snapshot", self.name)
+
+        self.automation_handler = automation_handler
+        self.parked = False
+        self.parking = False
+        self.__refresh_available_at()
+        self.on_phase(PHASE_READY)
+        return True
+
+    def __handle_send(self, queued: QueuedPostcard):
+        if not self.__wake():
+            self.queue.requeue(queued.postcard_id, "The device did not wake up",
+                               MAX_SEND_ATTEMPTS, count_attempt=False)
+            with self.state_lock:
+                self.available_at = datetime.now() + timedelta(seconds=BOOT_LEAD_TIME)
+            return
+
+        outcome = self.__send(queued)
+        # The device is only queried once after each send, never while idle
+        self.__refresh_available_at(
+            POSTCARD_COOLDOWN if outcome == SendOutcome.SENT else UNKNOWN_COOLDOWN_SECONDS)
+
+    def __release_failed_send(self, queued: QueuedPostcard, error: Exception):
+        """
+        Hands back a postcard whose send task failed outside of the send flow, so it does not
+        stay in flight until the next restart. A postcard which may have been sent is failed
+        instead of queued again.
+        """
+        try:
+            status = self.queue.status(queued.postcard_id)
+            if status is None or status["state"] != IN_FLIGHT:
+                return
+            if self.queue.checkpoints(queued.postcard_id) & SENDING_STEPS:
+                self.queue.mark_failed(
+                    queued.postcard_id,
+                    f"Sending failed after pressing send, check the app before retrying: {error}")
+            else:
+                self.queue.requeue(queued.postcard_id, str(error), MAX_SEND_ATTEMPTS,
+                                   count_attempt=False)
+        except Exception:
+            logging.exception("Worker %s failed to hand back postcard %s",
+                              self.name, queued.postcard_id)
+
+    def __start(self):
+        logging.info("Worker %s started", self.name)
+        while (task := self.inbox.get()) is not None:
+            action, queued = task
+            # A failing task, e.g. because the adb server restarted, must not end the worker
+            # while the dispatcher still hands it postcards
+            try:
+                if action == PARK:
+                    self.__park()
+                elif action == WAKE:
+                    self.__wake()
+                elif action == PREPARE:
+                    # A parked device gets the image once it is woken up to send
+                    if not self.parked:
+                        self.__prepare(queued)
+                else:
+                    self.__handle_send(queued)
+            except Exception as error:
+                logging.exception("Worker %s failed the %s task", self.name, action)
+                if action == PREPARE:
+                    # Staged again with the next pass of the dispatcher
+                    self.staged_postcard_id = None
+                elif action == SEND:
+                    with self.state_lock:
+                        self.available_at = datetime.now() + \
+                            timedelta(seconds=UNKNOWN_COOLDOWN_SECONDS)
+                    self.__release_failed_send(queued, error)
+            if action == SEND:
+                self.on_available(self)
+        logging.info("Worker %s stopped", self.name)
 
 
 class PostcardScheduler:
     """
-    A class for scheduling postcard sending
+    A class for scheduling postcard sending over a pool of devices.
+    A dispatcher keeps the workers in a heap keyed on the time their account is available
+    again and wakes up exactly when the next slot opens.
+    Devices with an avd are parked while idle and booted ahead of the slots the queue needs.
     """
 
-    def __init__(self):
-        self.automation_handler = AutomationHandler()
-        self.queue = Queue()
+    def __init__(self, device_configs: List[DeviceConfig] = None, queue_file: str = None,
+                 automation_factory=None, on_change=None):
+        if device_configs is None:
+            device_configs = load_device_configs()
+
+        # Changes of the postcards are reported to on_change, e.g. to notify subscribed clients
+        self.queue = PersistentPostcardQueue(
+            queue_file or os.environ.get('QUEUE_FILE', DEFAULT_QUEUE_FILE), on_change)
         self.safe_timeout = 60
-        self.worker_thread = Thread(target=self.__start)
-        self.worker_thread.start()
 
-    def schedule_postcard(self, postcard: Postcard):
+        self.condition = Condition()
+        self.running = True
+        # Heap of (wakeup time, sequence number, worker)
+        self.available_workers = []
+        self.sequence = itertools.count()
+
+        self.device_configs = device_configs
+        # Builds the automation handler of a device from its config and a phase callback
+        self.automation_factory = automation_factory
+        self.workers: List[PostcardWorker] = []
+        self.device_phases = {config.name: {"phase": PHASE_PENDING, "error": None}
+                              for config in device_configs}
+        self.dispatcher_thread = Thread(target=self.__dispatch, name='dispatcher')
+        self.dispatcher_thread.start()
+
+        self.autoscale_event = Event()
+        self.autoscale_lock = Lock()
+        self.emulator_slots = EmulatorSlots(MAX_RUNNING_EMULATORS)
+        self.autoscaling = any(config.avd for config in device_configs)
+        if self.autoscaling:
+            Thread(target=self.__autoscale, name='autoscaler', daemon=True).start()
+
+        # Devices are brought up concurrently in the background, postcards are
+        # queued in the meantime. Their adb io shares one event loop.
+        for config in device_configs:
+            Thread(target=self.__bring_up, args=(config,),
+                   name=f'{config.name}-bring-up', daemon=True).start()
+        logging.info("Scheduler started, bringing up %s devices", len(device_configs))
+
+    def __set_phase(self, name: str, phase: str, error: str = None):
+        with self.condition:
+            self.device_phases[name] = {"phase": phase, "error": error}
+        logging.info("Device %s is now in phase %s", name, phase)
+        if phase == PHASE_PARKED:
+            # The stopped emulator frees a slot for a device waiting to boot
+            self.autoscale_event.set()
+
+    def __release_emulator(self, emulator: Emulator):
+        try:
+            emulator.stop()
+        except (EmulatorError, OSError):
+            logging.exception("Failed to stop the emulator of device %s", emulator.name)
+            return
+        self.emulator_slots.release()
+
+    def __bring_up(self, config: DeviceConfig):
+        emulator = None
+        try:
+            if config.avd:
+                emulator = Emulator(config)
+                # Waits until the bound of running emulators leaves room for this one
+                self.emulator_slots.acquire()
+                self.__set_phase(config.name, PHASE_BOOTING)
+                emulator.boot()
+            worker = PostcardWorker(config, self.queue, self.__worker_available,
+                                    lambda phase: self.__set_phase(config.name, phase),
+                                    self.automation_factory, emulator, self.emulator_slots)
+        except Exception as error:
+            logging.exception("Failed to bring up device %s", config.name)
+            self.__set_phase(config.name, PHASE_FAILED, str(error))
+            if emulator is not None:
+                self.__release_emulator(emulator)
+            return
+
+        if not worker.automation_handler.logged_in:
+            self.__set_phase(config.name, PHASE_FAILED, "Login failed")
+            if emulator is not None:
+                worker.automation_handler.close()
+                self.__release_emulator(emulator)
+            return
+
+        if emulator is not None and (worker.automation_handler.login_required
+                                     or not emulator.has_snapshot()):
+            # Later boots restore the installed and logged in app instead of setting it up again
+            try:
+                emulator.save_snapshot()
+            except (EmulatorError, OSError):
+                logging.exception("Failed to save the snapshot of device %s", config.name)
+
+        with self.condition:
+            self.workers.append(worker)
+        self.__set_phase(config.name, PHASE_READY)
+        worker.start()
+
+    def device_status(self):
+        """
+        Returns the bring up phase of every device
+
+        Returns:
+            dict: The phase and error of each device keyed by its name
+        """
+        with self.condition:
+            return {name: dict(status) for name, status in self.device_phases.items()}
+
+    def is_ready(self):
+        """
+        Returns whether at least one device is ready to send postcards
+        """
+        with self.condition:
+            return any(status["phase"] in (PHASE_READY, PHASE_PARKED)
+                       for status in self.device_phases.values())
+
+    def __worker_available(self, worker: PostcardWorker):
+        available_at = worker.get_available_at()
+        now = datetime.now()
+        # Give the app some time to actually unlock the free postcard
+        wakeup = available_at + timedelta(seconds=self.safe_timeout) \
+            if available_at > now else now
+
+        with self.condition:
+            heapq.heappush(self.available_workers,
+                           (wakeup, next(self.sequence), worker))
+            self.condition.notify()
+
+        if self.autoscaling:
+            # Devices which are parked now must not get an image staged first
+            self.__scale_emulators()
+        self.__stage_next_postcards()
+
+    def __stage_next_postcards(self):
+        """
+        Hands every waiting worker the postcard it will most likely send next,
+        so its image is pushed and verified before the slot opens
+        """
+        with self.condition:
+            waiting_workers = [worker for _, _, worker in sorted(self.available_workers)]
+
+        for position, worker in enumerate(waiting_workers):
+            if worker.get_timeout_seconds() == 0 or worker.is_parked():
+                continue
+            queued = self.queue.peek(position)
+            if queued is None:
+                break
+            if worker.staged_postcard_id != queued.postcard_id:
+                worker.prepare(queued)
+
+    def __wait_for_slot(self):
+        """
+        Blocks until the slot of a worker is open and a postcard is queued
+
+        Returns:
+            PostcardWorker: The worker with the open slot or None on shutdown
+        """
+        with self.condition:
+            while self.running:
+                if not self.available_workers or self.queue.empty():
+                    self.condition.wait()
+                    continue
+
+                wakeup = self.available_workers[0][0]
+                seconds_left = (wakeup - datetime.now()).total_seconds()
+                if seconds_left <= 0:
+                    return heapq.heappop(self.available_workers)[2]
+
+                logging.info(
+                    "Scheduler sleeping until %s when the next postcard can be sent", wakeup)
+                self.condition.wait(seconds_left)
+        return None
+
+    def __dispatch(self):
+        logging.info("Scheduler dispatcher started")
+        while (worker := self.__wait_for_slot()) is not None:
+            queued = self.queue.get_nowait()
+            if queued is None:
+                # The postcard was cancelled in the meantime
+                self.__worker_available(worker)
+                continue
+            worker.send(queued)
+        logging.info("Scheduler dispatcher stopped")
+
+    def __wake_dispatcher(self):
+        with self.condition:
+            self.condition.notify()
+        self.autoscale_event.set()
+
+    def __scale_emulators(self):
+        """
+        Boots the parked devices whose slot opens soon and is needed for the queued postcards,
+        and parks the idle devices whose slot is not needed or far away
+        """
+        now = datetime.now()
+        with self.autoscale_lock:
+            with self.condition:
+                # Idle workers in the order the dispatcher hands them postcards, then the busy ones
+                idle_workers = [worker for _, _, worker in sorted(self.available_workers)]
+                workers = idle_workers + sorted(
+                    (worker for worker in self.workers if worker not in idle_workers),
+                    key=lambda worker: worker.get_available_at())
+            queued = self.queue.qsize()
+
+            # Every queued postcard takes the next slot, so the first workers by slot are needed
+            needed = {worker: position < queued and worker.get_available_at() - now
+                      <= timedelta(seconds=BOOT_LEAD_TIME)
+                      for position, worker in enumerate(workers) if worker.emulator}
+            # Devices are parked first, their stopped emulators make room for the needed ones
+            for worker, is_needed in needed.items():
+                if not is_needed and not worker.is_parked() and worker in idle_workers:
+                    logging.info("Parking device %s until its next slot", worker.name)
+                    worker.park()
+
+            running = self.emulator_slots.running
+            for worker, is_needed in needed.items():
+                if is_needed and worker.is_parked() and \
+                        (not MAX_RUNNING_EMULATORS or running < MAX_RUNNING_EMULATORS):
+                    logging.info("Waking up device %s for its next slot", worker.name)
+                    worker.wake()
+                    running += 1
+
+    def __autoscale(self):
+        logging.info("Emulator autoscaler started")
+        while self.running:
+            self.autoscale_event.wait(AUTOSCALE_INTERVAL)
+            self.autoscale_event.clear()
+            if self.running:
+                self.__scale_emulators()
+                # Woken devices get their image once they are up
+                self.__stage_next_postcards()
+        logging.info("Emulator autoscaler stopped")
+
+    def shutdown(self):
+        """
+        Stops the dispatcher and the workers, postcards being sent are finished first
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.autoscale_event.set()
+        for worker in self.workers:
+            worker.stop()
+
+    def __estimate_seconds_until(self, positions: List[int]):
+        """
+        Estimates the seconds until the postcards at the given queue positions are sent,
+        assigning every postcard to the worker which becomes available first.
+        Every worker takes its own next available time and its measured send duration.
+        All positions are answered by one walk of the queue up to the last of them.
+
+        Args:
+            positions (List[int]): The zero based positions in the queue
+
+        Returns:
+            Dict[int, int]: The number of seconds per position or None if no device is available
+        """
+        with self.condition:
+            workers = list(self.workers)
+            names = {worker.name for worker in workers}
+            pending_devices = sum(name not in names and status["phase"] != PHASE_FAILED
+                                  for name, status in self.device_phases.items())
+        # Heap of (seconds until the slot opens, seconds a send takes)
+        slots = []
+        for worker in workers:
+            seconds = worker.get_timeout_seconds()
+            slots.append((seconds + self.safe_timeout if seconds != 0 else 0,
+                          worker.get_send_seconds()))
+        # Devices still being brought up are assumed to be available right away
+        slots += [(0, DEFAULT_SEND_SECONDS)] * pending_devices
+        if not slots:
+            return {position: None for position in positions}
+        heapq.heapify(slots)
+
+        # The cooldown of a slot starts once its postcard is sent
+        wanted = set(positions)
+        seconds_until = {}
+        for position in range(max(wanted, default=-1) + 1):
+            opens_in, send_seconds = heapq.heappop(slots)
+            if position in wanted:
+                seconds_until[position] = int(opens_in + send_seconds)
+            heapq.heappush(slots, (opens_in + send_seconds + POSTCARD_COOLDOWN + self.safe_timeout,
+                                   send_seconds))
+        return seconds_until
+
+    def __estimate_send_time(self, position: int):
+        time_remaining = self.__estimate_seconds_until([position])[position]
+        if time_remaining is None:
+            return "an unknown time, no device is available"
+        return datetime.now() + timedelta(seconds=time_remaining)
+
+    def schedule_postcard(self, postcard: Postcard, priority: int = 0, deadline: datetime = None):
         """
         Adds a postcard to the scheduler to be sent automatically once possible
 
         Args:
             postcard (Postcard): The postcard to append
+            priority (int): Postcards with a higher priority are sent first
+            deadline (datetime, optional): Postcards of the same priority are sent by deadline
+
+        Returns:
+            int: The id of the queued postcard
         """
 
         # Compute the time when the postcard will be sent normally
-        if (remaining_until_next := self.automation_handler.get_timeout_seconds()) != 0:
-            time_remaining = remaining_until_next + \
-                (self.queue.qsize() * (86400 + self.safe_timeout)) + self.safe_timeout
-        else:
-            time_remaining = remaining_until_next + \
-                (self.queue.qsize() * (86400 + self.safe_timeout))
+        time_sent = self.__estimate_send_time(self.queue.qsize())
+
+        postcard_id = self.queue.put(postcard, priority, deadline)
+        self.__wake_dispatcher()
+        self.__stage_next_postcards()
+
+        logging.info(
+            "Postcard %s added to the queue, it will be sent at %s", postcard_id, time_sent)
+
+        return postcard_id
+
+    def schedule_postcards(self, postcards: List[Postcard], priority: int = 0,
+                           deadline: datetime = None):
+        """
+        Adds several postcards to the scheduler at once, either all or none are queued
 
-        time_sent = datetime.now() + timedelta(seconds=time_remaining)
+        Args:
+            postcards (List[Postcard]): The postcards to append
+            priority (int): Postcards with a higher priority are sent first
+            deadline (datetime, optional): Postcards of the same priority are sent by deadline
+
+        Returns:
+            List[int]: The ids of the queued postcards
+        """
+        time_sent = self.__estimate_send_time(self.queue.qsize() + len(postcards) - 1)
 
-        self.queue.put(postcard)
+        postcard_ids = self.queue.put_many(postcards, priority, deadline)
+        self.__wake_dispatcher()
+        self.__stage_next_postcards()
 
         logging.info(
-            "Postcard added to the queue, it will be sent at %s", time_sent)
+            "%s postcards added to the queue, the last will be sent at %s",
+            len(postcard_ids), time_sent)
+
+        return postcard_ids
 
-    def scheduler_run(self):
+    def cancel_postcard(self, postcard_id: int):
         """
-        A run of the scheduler which sends the postcards
+        Removes a postcard from the queue if it was not sent yet
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            bool: Whether the postcard was cancelled
         """
-        time_remaining = self.automation_handler.get_timeout_seconds()
+        cancelled = self.queue.cancel(postcard_id)
+        if cancelled:
+            logging.info("Postcard %s cancelled", postcard_id)
+        return cancelled
 
-        if time_remaining > 0:
-            time_remaining += self.safe_timeout
-            time_wakeup = datetime.now() + timedelta(seconds=time_remaining)
-            logging.info(
-                "Scheduler sleeping until %s when the next postcard can be sent", time_wakeup)
+    def cooldowns(self):
+        """
+        Returns the seconds until every ready device can send its next postcard
 
-            sleep(time_remaining)
-            return
+        Returns:
+            dict: The seconds keyed by the name of the device
+        """
+        with self.condition:
+            workers = list(self.workers)
+        return {worker.name: worker.get_timeout_seconds() for worker in workers}
 
-        postcard_to_be_sent: Postcard = self.queue.get()
+    def failed_postcards(self, limit: int = 100):
+        """
+        Returns the postcards which failed permanently and are not retried
 
-        logging.info("Sending postcard with description %s",
-                     postcard_to_be_sent.description)
+        Args:
+            limit (int): The maximum number of postcards returned
 
-        self.automation_handler.send_postcard(postcard_to_be_sent)
+        Returns:
+            List[dict]: The failed postcards with the reason of the failure, the most recent first
+        """
+        return self.queue.dead_letters(limit)
 
     def estimated_queue_finish(self):
         """
         Return the amount of seconds remaining until the whole queue is finished
 
         Returns:
-            int: the number of seconds as integer
+            int: the number of seconds as integer or None if no device is available
         """
-        return self.automation_handler.get_timeout_seconds() + \
-            (self.queue.qsize() * (86400 + self.safe_timeout)) + self.safe_timeout
+        queued = self.queue.qsize()
+        if queued == 0:
+            return 0
+        return self.__estimate_seconds_until([queued - 1])[queued - 1]
 
-    def __start(self):
-        logging.info("Scheduler started")
-        while True:
-            if self.queue.empty():
-                logging.info("Queue is now empty, going to sleep")
-            self.scheduler_run()
+    def postcard_statuses(self, postcard_ids: List[int]):
+        """
+        Returns the state of several postcards and, while they are waiting or being sent,
+        the time they are expected to be sent, without touching any device.
+        The queue and the slots of the devices are walked once for all of them.
+
+        Args:
+            postcard_ids (List[int]): The ids of the postcards
+
+        Returns:
+            Dict[int, dict]: The status of every existing postcard, keyed by its id
+        """
+        statuses = self.queue.statuses(postcard_ids)
+        seconds_until = self.__estimate_seconds_until(
+            [status["position"] for status in statuses.values() if status["state"] == QUEUED])
+        with self.condition:
+            send_seconds = max((worker.get_send_seconds() for worker in self.workers),
+                               default=DEFAULT_SEND_SECONDS)
+
+        now = datetime.now()
+        for status in statuses.values():
+            seconds = None
+            if status["state"] == QUEUED:
+                seconds = seconds_until[status["position"]]
+            elif status["state"] == IN_FLIGHT:
+                elapsed = now - datetime.fromisoformat(status["updated_at"])
+                seconds = max(0, send_seconds - elapsed.total_seconds())
+            status["estimated_send_time"] = now + timedelta(seconds=seconds) \
+                if seconds is not None else None
+        return statuses
+
+    def postcard_status(self, postcard_id: int):
+        """
+        Returns the state of a postcard and, while it is waiting or being sent,
+        the time it is expected to be sent, without touching any device
+
+        Args:
+            postcard_id (int): The id of the postcard
+
+        Returns:
+            dict: The status of the postcard or None if there is no such postcard
+        """
+        return self.postcard_statuses([postcard_id]).get(postcard_id)
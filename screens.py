@@ -0,0 +1,91 @@
+"""
+Module containing the classification of the current screen of the postcardcreator app
+"""
+
+from enum import Enum
+from typing import List, Tuple
+
+import locators
+from locators import INPUT_FIELD_CLASS
+from ui_snapshot import UiSnapshot
+
+RECIPIENT_FORM_FIELDS = 7
+
+
+class Screen(Enum):
+    """
+    The screens of the app relevant for logging in and sending postcards
+    """
+    UNKNOWN = 'unknown'
+    WELCOME = 'welcome'
+    LOGIN = 'login'
+    SWISSID_LOGIN = 'swissid_login'
+    SWISSID_2FA = 'swissid_2fa'
+    SWISSID_CANCELLED = 'swissid_cancelled'
+    SWISSID_INCORRECT = 'swissid_incorrect'
+    HOME = 'home'
+    COOLDOWN = 'cooldown'
+    PERMISSION_DIALOG = 'permission_dialog'
+    LOW_RESOLUTION_WARNING = 'low_resolution_warning'
+    IMAGE_PICKER_RECENT = 'image_picker_recent'
+    IMAGE_PICKER = 'image_picker'
+    IMAGE_SELECT = 'image_select'
+    LOCATION_SELECT = 'location_select'
+    RECIPIENT = 'recipient'
+    RECIPIENT_FORM = 'recipient_form'
+    MESSAGE = 'message'
+    TERMS = 'terms'
+    NEXT = 'next'
+    SENT = 'sent'
+
+
+LOGIN_SCREENS = (Screen.WELCOME, Screen.LOGIN, Screen.SWISSID_LOGIN,
+                 Screen.SWISSID_2FA, Screen.SWISSID_CANCELLED, Screen.SWISSID_INCORRECT)
+
+
+def _input_fields(count):
+    return lambda snapshot: len(snapshot.by_class.get(INPUT_FIELD_CLASS, [])) >= count
+
+
+# Ordered from the most to the least specific screen, dialogs come first as they
+# are drawn on top of the screen below them
+SCREEN_RULES: List[Tuple[Screen, callable]] = [
+    (Screen.SWISSID_CANCELLED, locators.SWISSID_CANCELLED.find),
+    (Screen.SWISSID_INCORRECT, locators.SWISSID_INCORRECT.find),
+    (Screen.SWISSID_2FA, locators.SWISSID_2FA.find),
+    (Screen.SWISSID_LOGIN, locators.SWISSID_LOGIN.find),
+    (Screen.LOGIN, locators.LOGIN_WITH_SWISSID.find),
+    (Screen.WELCOME, locators.LOGIN_REGISTRATION.find),
+    (Screen.PERMISSION_DIALOG, locators.ALLOW.find),
+    (Screen.LOW_RESOLUTION_WARNING, locators.LOW_RESOLUTION_OK.find),
+    (Screen.COOLDOWN, locators.AVAILABLE_AGAIN.find),
+    (Screen.HOME, lambda snapshot: (
+        locators.CREATE_FREE_POSTCARD.find(snapshot) or locators.CREATE_POSTCARD.find(snapshot))),
+    (Screen.IMAGE_PICKER_RECENT, lambda snapshot: (
+        locators.RECENT.find(snapshot) and locators.SHOW_ROOTS.find(snapshot))),
+    (Screen.IMAGE_PICKER, locators.SHOW_ROOTS.find),
+    (Screen.LOCATION_SELECT, locators.SELECT_LOCATION.find),
+    (Screen.RECIPIENT_FORM, _input_fields(RECIPIENT_FORM_FIELDS)),
+    (Screen.RECIPIENT, locators.RECIPIENT.find),
+    (Screen.IMAGE_SELECT, locators.SELECT_IMAGE.find),
+    (Screen.MESSAGE, locators.ENTER_MESSAGE.find),
+    (Screen.TERMS, locators.SEND.find),
+    (Screen.SENT, locators.SENT_HOME.find),
+    (Screen.NEXT, locators.NEXT.find),
+]
+
+
+def classify_screen(snapshot: UiSnapshot):
+    """
+    Identifies the current screen from a single ui snapshot
+
+    Args:
+        snapshot (UiSnapshot): The snapshot of the current ui
+
+    Returns:
+        Screen: The identified screen or Screen.UNKNOWN
+    """
+    for screen, rule in SCREEN_RULES:
+        if rule(snapshot):
+            return screen
+    return Screen.UNKNOWN
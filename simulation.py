@@ -0,0 +1,575 @@
+"""
+Module containing an in-process simulation of a device running the postcardcreator app,
+implementing the parts of the webdriver and adb surfaces used by the automations
+"""
+
+import asyncio
+import math
+import os
+import re
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import RLock
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+from xml.sax.saxutils import quoteattr
+
+from appium.webdriver.common.appiumby import AppiumBy
+from selenium.common.exceptions import (NoSuchElementException,
+                                        StaleElementReferenceException,
+                                        WebDriverException)
+
+from adb_automations import DEVICE_DOWNLOAD_FOLDER
+from appium_automations import KEYCODE_PASTE
+from locators import (BUTTON_CLASS, INPUT_FIELD_CLASS, LAYOUT_CLASS, SWITCH_CLASS, TEXT_CLASS,
+                      Selector)
+from models import STEP_CONFIRMED, STEP_SENT, SendOutcome, SendResult
+from scheduler import POSTCARD_COOLDOWN
+
+IMAGE_BUTTON_CLASS = "android.widget.ImageButton"
+NODE_HEIGHT = 100
+
+# Seconds per round trip, measured roughly against an emulator on the same host
+DEFAULT_DRIVER_LATENCY = {'default': 0.05, 'page_source': 0.15, 'find_elements': 0.08}
+DEFAULT_ADB_LATENCY = {'default': 0.02, 'push': 0.05}
+# Bytes per second of a push
+ADB_PUSH_THROUGHPUT = 20 * 1024 * 1024
+
+
+class SimulatedClock:
+    """
+    A clock compressing the time of the simulation, a time scale of 0.001 turns
+    the cooldown of a day into 86 seconds and every latency into a thousandth
+    """
+
+    def __init__(self, time_scale: float = 1.0):
+        self.time_scale = time_scale
+
+    def scaled(self, seconds: float):
+        """
+        Returns the real seconds the given simulated seconds take
+        """
+        return seconds * self.time_scale
+
+    def sleep(self, seconds: float):
+        """
+        Sleeps for the given simulated seconds
+        """
+        if seconds > 0:
+            sleep(self.scaled(seconds))
+
+
+@dataclass(eq=False)
+class SimulatedNode:
+    """
+    Dataclass for storing one node of the simulated ui and what tapping it does
+    """
+    class_name: str
+    text: str = ''
+    content_desc: str = ''
+    action: Optional[callable] = None
+    checked: Optional[bool] = None
+
+
+class SimulatedApp:
+    """
+    A model of the screens of the postcardcreator app, rendered as nodes
+    and advanced by tapping them
+    """
+
+    def __init__(self, clock: SimulatedClock, logged_in=True, cooldown=POSTCARD_COOLDOWN):
+        self.clock = clock
+        self.cooldown = cooldown
+        # Files on the device by path with their size
+        self.files: Dict[str, int] = {}
+        self.screen = 'home' if logged_in else 'welcome'
+        self.available_at: Optional[datetime] = None
+        self.permission_granted = False
+        self.drawer_open = False
+        self.focused: Optional[SimulatedNode] = None
+        self.clipboard = ''
+        self.sent_postcards: List[dict] = []
+        self.__reset_draft()
+        self.nodes: List[SimulatedNode] = []
+        self.rendered_cooldown = False
+        self.render()
+
+    def __reset_draft(self):
+        self.image = None
+        self.picked_image = None
+        self.recipient_fields = ['' for _ in range(7)]
+        self.message = ''
+        self.recipient_done = False
+        self.message_done = False
+
+    def is_cooling_down(self):
+        """
+        Returns whether the free postcard of the account is used up
+        """
+        return self.available_at is not None and datetime.now() < self.available_at
+
+    def expire_cooldown(self):
+        """
+        Makes the free postcard available again right away
+        """
+        self.available_at = None
+        self.render()
+
+    def launch(self):
+        """
+        Brings the app to the front, as done by monkey
+        """
+        self.render()
+
+    def go(self, screen: str):
+        """
+        Shows another screen
+        """
+        self.screen = screen
+        self.drawer_open = False
+        self.render()
+
+    def render(self):
+        """
+        Builds the nodes of the current screen, kept until the ui changes
+        """
+        self.nodes = getattr(self, f'_screen_{self.screen}')()
+
+    def current_nodes(self):
+        """
+        Returns the nodes shown right now, the home screen changes once the cooldown ends
+        """
+        if self.screen == 'home' and self.rendered_cooldown != self.is_cooling_down():
+            self.render()
+        return self.nodes
+
+    def activate(self, node: SimulatedNode):
+        """
+        Performs the action of a tapped node
+
+        Raises:
+            StaleElementReferenceException: If the node is not shown anymore
+        """
+        if node not in self.current_nodes():
+            raise StaleElementReferenceException(f"{node.class_name} {node.text} is not shown")
+        if node.class_name == INPUT_FIELD_CLASS:
+            self.focused = node
+        if node.action is not None:
+            node.action()
+
+    def images(self):
+        """
+        Returns the names of the images in the download folder
+        """
+        prefix = f'{DEVICE_DOWNLOAD_FOLDER}/'
+        return [path[len(prefix):] for path in self.files if path.startswith(prefix)]
+
+    # Screens
+
+    def _screen_welcome(self):
+        return [SimulatedNode(BUTTON_CLASS, "Login / registration",
+                              action=lambda: self.go('login'))]
+
+    def _screen_login(self):
+        return [SimulatedNode(BUTTON_CLASS, "Login with SwissID",
+                              action=lambda: self.go('swissid'))]
+
+    def _screen_swissid(self):
+        return [SimulatedNode(TEXT_CLASS, "Log in to Swiss Post"),
+                SimulatedNode(INPUT_FIELD_CLASS), SimulatedNode(INPUT_FIELD_CLASS),
+                SimulatedNode(BUTTON_CLASS, "Continue", action=lambda: self.go('home'))]
+
+    def _screen_home(self):
+        self.rendered_cooldown = self.is_cooling_down()
+        if self.rendered_cooldown:
+            return [SimulatedNode(
+                BUTTON_CLASS, f"Available again from {self.available_at:%d.%m.%Y at %H:%M}")]
+
+        def create():
+            self.__reset_draft()
+            self.go('image_select')
+        return [SimulatedNode(BUTTON_CLASS, "Create free postcard", action=create)]
+
+    def _screen_image_select(self):
+        nodes = [SimulatedNode(BUTTON_CLASS, "Select image", action=lambda: self.go(
+            'picker_recent' if self.permission_granted else 'permission'))]
+        if self.image:
+            nodes.append(SimulatedNode(BUTTON_CLASS, "Next", action=lambda: self.go('overview')))
+        return nodes
+
+    def _screen_permission(self):
+        def allow():
+            self.permission_granted = True
+            self.go('picker_recent')
+        return [SimulatedNode(BUTTON_CLASS, "Allow", action=allow)]
+
+    def _screen_picker_recent(self):
+        def open_drawer():
+            self.drawer_open = True
+            self.render()
+        nodes = [SimulatedNode(TEXT_CLASS, "Recent"),
+                 SimulatedNode(IMAGE_BUTTON_CLASS, content_desc="Show roots", action=open_drawer)]
+        if self.drawer_open:
+            nodes.append(SimulatedNode(TEXT_CLASS, "Downloads", action=lambda: self.go('picker')))
+        return nodes
+
+    def _screen_picker(self):
+        def pick(name):
+            self.picked_image = name
+            self.go('crop')
+        return [SimulatedNode(IMAGE_BUTTON_CLASS, content_desc="Show roots")] + [
+            SimulatedNode(LAYOUT_CLASS, content_desc=name, action=lambda name=name: pick(name))
+            for name in self.images()]
+
+    def _screen_crop(self):
+        def confirm():
+            self.image = self.picked_image
+            self.go('image_select')
+        return [SimulatedNode(TEXT_CLASS, "N", action=confirm)]
+
+    def _screen_overview(self):
+        def next_screen():
+            if self.recipient_done and self.message_done:
+                self.go('terms')
+        return [SimulatedNode(BUTTON_CLASS, "Recipient", action=lambda: self.go('recipient_form')),
+                SimulatedNode(BUTTON_CLASS, "Enter message",
+                              action=lambda: self.go('message_editor')),
+                SimulatedNode(BUTTON_CLASS, "Next", action=next_screen)]
+
+    def _screen_recipient_form(self):
+        fields = [SimulatedNode(INPUT_FIELD_CLASS, value) for value in self.recipient_fields]
+
+        def confirm():
+            self.recipient_fields = [field.text for field in fields]
+            # First name, last name, street and postal code are required
+            if all(value.strip() for value in self.recipient_fields[3:7]):
+                self.recipient_done = True
+                self.go('overview')
+        return fields + [SimulatedNode(BUTTON_CLASS, "Next", action=confirm)]
+
+    def _screen_message_editor(self):
+        field = SimulatedNode(INPUT_FIELD_CLASS, self.message)
+
+        def confirm():
+            self.message = field.text
+            self.message_done = bool(field.text.strip())
+            self.go('overview')
+        return [field, SimulatedNode(TEXT_CLASS, "N", action=confirm)]
+
+    def _screen_terms(self):
+        switch = SimulatedNode(SWITCH_CLASS, checked=False)
+
+        def toggle():
+            switch.checked = not switch.checked
+
+        def send():
+            if not switch.checked:
+                return
+            self.sent_postcards.append({"image": self.image, "recipient": self.recipient_fields,
+                                        "message": self.message})
+            # The banner only shows minutes, the cooldown ends with the minute shown
+            available_at = datetime.now() + timedelta(seconds=self.clock.scaled(self.cooldown))
+            self.available_at = available_at.replace(second=0, microsecond=0) + \
+                timedelta(minutes=1)
+            self.go('sent')
+        switch.action = toggle
+        return [switch, SimulatedNode(BUTTON_CLASS, "Send it now for free", action=send)]
+
+    def _screen_sent(self):
+        return [SimulatedNode(BUTTON_CLASS, "Home", action=lambda: self.go('home'))]
+
+
+class CommandStats:
+    """
+    Counts the round trips to a simulated backend and the seconds spent per command
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.seconds = defaultdict(float)
+
+    def record(self, command: str, seconds: float):
+        self.counts[command] += 1
+        self.seconds[command] += seconds
+
+    @property
+    def round_trips(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        self.counts.clear()
+        self.seconds.clear()
+
+
+class SimulatedElement:
+    """
+    A webelement of the simulated driver
+    """
+
+    def __init__(self, driver: 'SimulatedDriver', node: SimulatedNode):
+        self.driver = driver
+        self.node = node
+        self.id = uuid.uuid4().hex
+        driver.elements[self.id] = self
+
+    @property
+    def text(self):
+        self.driver.command('text')
+        return self.node.text
+
+    def get_attribute(self, name: str):
+        self.driver.command('get_attribute')
+        if name == 'checked':
+            return str(bool(self.node.checked)).lower()
+        return {'text': self.node.text, 'content-desc': self.node.content_desc}.get(name)
+
+    def click(self):
+        self.driver.command('click')
+        self.driver.app.activate(self.node)
+
+    def clear(self):
+        self.driver.command('clear')
+        self.node.text = ''
+
+    def send_keys(self, value: str):
+        self.driver.command('send_keys')
+        self.node.text += value
+
+
+class SimulatedDriver:
+    """
+    A webdriver talking to a simulated app, every command costs one round trip of latency
+    """
+
+    def __init__(self, app: SimulatedApp, clock: SimulatedClock, latency: Dict[str, float] = None):
+        self.app = app
+        self.clock = clock
+        self.latency = {**DEFAULT_DRIVER_LATENCY, **(latency or {})}
+        self.session_id = uuid.uuid4().hex
+        self.elements: Dict[str, SimulatedElement] = {}
+        self.stats = CommandStats()
+
+    def command(self, name: str):
+        """
+        Waits for the latency of one round trip and records it
+        """
+        started = monotonic()
+        self.clock.sleep(self.latency.get(name, self.latency['default']))
+        self.stats.record(name, monotonic() - started)
+
+    def __nodes_with_bounds(self):
+        return [(node, (0, index * NODE_HEIGHT, 1080, (index + 1) * NODE_HEIGHT))
+                for index, node in enumerate(self.app.current_nodes())]
+
+    @property
+    def page_source(self):
+        self.command('page_source')
+        lines = ['<hierarchy>']
+        for node, (left, top, right, bottom) in self.__nodes_with_bounds():
+            checked = 'false' if node.checked is None else str(node.checked).lower()
+            lines.append(
+                f'<{node.class_name} class="{node.class_name}" text={quoteattr(node.text)} '
+                f'content-desc={quoteattr(node.content_desc)} resource-id="" '
+                f'checked="{checked}" bounds="[{left},{top}][{right},{bottom}]"/>')
+        lines.append('</hierarchy>')
+        return '\n'.join(lines)
+
+    @property
+    def orientation(self):
+        self.command('orientation')
+        return 'PORTRAIT'
+
+    def find_elements(self, by: str, value: str):
+        self.command('find_elements')
+        if by == AppiumBy.CLASS_NAME:
+            selector = Selector(class_name=value)
+        elif by == AppiumBy.ANDROID_UIAUTOMATOR:
+            selector = Selector.parse(value)
+        else:
+            raise WebDriverException(f"The simulation does not support locating by {by}")
+        return [SimulatedElement(self, node) for node in self.app.current_nodes()
+                if selector.matches(node)]
+
+    def find_element(self, by: str, value: str):
+        raise NoSuchElementException(f"No element with {by} {value}")
+
+    def tap(self, positions, duration=None):
+        self.command('tap')
+        x, y = positions[0]
+        for node, (left, top, right, bottom) in self.__nodes_with_bounds():
+            if left <= x < right and top <= y < bottom:
+                self.app.activate(node)
+                return self
+        return self
+
+    def execute_script(self, script: str, arguments: dict = None):
+        self.command('execute_script')
+        if script != 'mobile: replaceElementValue':
+            raise WebDriverException(f"The simulation does not support {script}")
+        element = self.elements[arguments['elementId']]
+        if element.node not in self.app.current_nodes():
+            raise StaleElementReferenceException("The field is not shown anymore")
+        element.node.text = arguments['text']
+
+    def set_clipboard_text(self, text: str):
+        self.command('set_clipboard')
+        self.app.clipboard = text
+
+    def press_keycode(self, keycode: int):
+        self.command('press_keycode')
+        if keycode == KEYCODE_PASTE and self.app.focused is not None:
+            self.app.focused.text += self.app.clipboard
+
+    def implicitly_wait(self, seconds: float):
+        self.command('implicitly_wait')
+
+    def quit(self):
+        self.command('quit')
+
+
+class SimulatedSession:
+    """
+    An appium session of a simulated device, which never dies
+    """
+
+    def __init__(self, driver: SimulatedDriver):
+        self.driver = driver
+        self.lock = RLock()
+
+    def ensure_alive(self):
+        """
+        Checks the session with one round trip like a real session
+        """
+        self.driver.orientation
+        return self.driver
+
+    def stop(self):
+        """
+        Nothing to stop for a simulated session
+        """
+
+
+class SimulatedDevice:
+    """
+    A simulated device with the postcardcreator app and its appium session
+    """
+
+    def __init__(self, serial: str, clock: SimulatedClock = None,
+                 driver_latency: Dict[str, float] = None, logged_in=True,
+                 cooldown=POSTCARD_COOLDOWN):
+        self.serial = serial
+        self.clock = clock or SimulatedClock()
+        self.app = SimulatedApp(self.clock, logged_in, cooldown)
+        self.driver = SimulatedDriver(self.app, self.clock, driver_latency)
+        self.session = SimulatedSession(self.driver)
+
+
+class SimulatedAdbClient:
+    """
+    An asyncio adb client talking to simulated devices, implementing the commands
+    sent by the adb automations
+    """
+
+    TEST_AND_TOUCH = re.compile(r'\[ -f (\S+) \] && touch \S+ && echo present')
+    STAT_SIZE = re.compile(r'stat -c %s (\S+)')
+
+    def __init__(self, devices: List[SimulatedDevice], clock: SimulatedClock = None,
+                 latency: Dict[str, float] = None):
+        self.devices_by_serial = {device.serial: device for device in devices}
+        self.clock = clock or SimulatedClock()
+        self.latency = {**DEFAULT_ADB_LATENCY, **(latency or {})}
+        self.stats = CommandStats()
+
+    async def __command(self, name: str, extra_seconds: float = 0):
+        started = monotonic()
+        seconds = self.latency.get(name, self.latency['default']) + extra_seconds
+        await asyncio.sleep(self.clock.scaled(seconds))
+        self.stats.record(name, monotonic() - started)
+
+    def __app(self, serial: str):
+        return self.devices_by_serial[serial].app
+
+    async def devices(self):
+        await self.__command('devices')
+        return list(self.devices_by_serial)
+
+    async def shell(self, serial: str, command: str):
+        await self.__command('shell')
+        app = self.__app(serial)
+
+        if match := self.TEST_AND_TOUCH.fullmatch(command):
+            return 'present\n' if match.group(1) in app.files else ''
+        if match := self.STAT_SIZE.match(command):
+            size = app.files.get(match.group(1))
+            return f'{size}\n' if size is not None else ''
+        if command.startswith('rm -f '):
+            for path in command.split()[2:]:
+                app.files.pop(path, None)
+            return ''
+        if command.startswith('pm path '):
+            return 'package:/data/app/base.apk\n'
+        if command.startswith('monkey '):
+            app.launch()
+            return 'Events injected: 1\n'
+        return ''
+
+    async def push(self, serial: str, source: str, destination: str, mode=None):
+        size = os.path.getsize(source)
+        await self.__command('push', size / ADB_PUSH_THROUGHPUT)
+        self.__app(serial).files[destination] = size
+
+    async def is_installed(self, serial: str, package: str):
+        return 'package:' in await self.shell(serial, f'pm path {package}')
+
+    async def install(self, serial: str, apk: str):
+        await self.__command('install')
+
+    def close(self):
+        pass
+
+
+class SimulatedAutomationHandler:
+    """
+    A stand-in for the automation handler of a device, sending every postcard in a fixed time,
+    used to measure the scheduler without the ui flow
+    """
+
+    def __init__(self, device_config, on_phase=None, clock: SimulatedClock = None,
+                 send_seconds: float = 30, cooldown=POSTCARD_COOLDOWN, available_in: float = 0):
+        self.name = device_config.name
+        self.clock = clock or SimulatedClock()
+        self.send_seconds = send_seconds
+        self.cooldown = cooldown
+        self.logged_in = True
+        self.login_required = False
+        self.updated_timestamp = datetime.now()
+        self.available_at = self.updated_timestamp + \
+            timedelta(seconds=self.clock.scaled(available_in))
+        self.time_remaining = self.get_timeout_seconds()
+        # The time each slot opened and the time its postcard was started
+        self.sends: List[tuple] = []
+
+    def send_postcard(self, postcard, checkpoints: set = None, on_checkpoint=None):
+        started = datetime.now()
+        if started < self.available_at:
+            return SendResult(outcome=SendOutcome.UNAVAILABLE,
+                              reason="The free postcard is not available yet")
+        self.sends.append((self.available_at, started))
+        self.clock.sleep(self.send_seconds)
+        self.available_at = datetime.now() + timedelta(seconds=self.clock.scaled(self.cooldown))
+        if checkpoints is not None:
+            checkpoints.update({STEP_SENT, STEP_CONFIRMED})
+            if on_checkpoint is not None:
+                on_checkpoint(set(checkpoints))
+        return SendResult(outcome=SendOutcome.SENT)
+
+    def prepare_postcard(self, postcard):
+        return True
+
+    def get_timeout_seconds(self):
+        return max(0, math.ceil((self.available_at - datetime.now()).total_seconds()))
+
+    def close(self):
+        pass
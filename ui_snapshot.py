@@ -0,0 +1,116 @@
+"""
+Module containing the parsing of page source snapshots to resolve ui elements locally
+"""
+
+import re
+import xml.etree.ElementTree as ElementTree
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from appium.webdriver.common.appiumby import AppiumBy
+
+BOUNDS_REGEX = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+
+
+@dataclass
+class UiNode:
+    """
+    Dataclass for storing one node of the ui hierarchy
+    """
+    class_name: str
+    text: str
+    content_desc: str
+    resource_id: str
+    bounds: Optional[Tuple[int, int, int, int]]
+    attributes: Dict[str, str] = field(default_factory=dict)
+
+    def center(self):
+        """
+        Returns the center of the node on the screen
+
+        Returns:
+            Tuple[int, int]: The x and y coordinates
+        """
+        left, top, right, bottom = self.bounds
+        return (left + right) // 2, (top + bottom) // 2
+
+
+class UiSnapshot:
+    """
+    A parsed page source indexing all nodes by class and content-desc
+    """
+
+    def __init__(self, page_source: str):
+        self.nodes: List[UiNode] = []
+        self.by_class: Dict[str, List[UiNode]] = defaultdict(list)
+        self.by_content_desc: Dict[str, List[UiNode]] = defaultdict(list)
+        self.resource_id_count: Dict[str, int] = defaultdict(int)
+
+        for element in ElementTree.fromstring(page_source).iter():
+            if 'class' not in element.attrib:
+                continue
+            node = self.__parse_node(element.attrib)
+            self.nodes.append(node)
+            self.by_class[node.class_name].append(node)
+            if node.content_desc:
+                self.by_content_desc[node.content_desc].append(node)
+            if node.resource_id:
+                self.resource_id_count[node.resource_id] += 1
+
+    @staticmethod
+    def __parse_node(attributes: Dict[str, str]):
+        bounds = None
+        if match := BOUNDS_REGEX.fullmatch(attributes.get('bounds', '')):
+            bounds = tuple(int(value) for value in match.groups())
+
+        return UiNode(
+            class_name=attributes['class'],
+            text=attributes.get('text', ''),
+            content_desc=attributes.get('content-desc', ''),
+            resource_id=attributes.get('resource-id', ''),
+            bounds=bounds,
+            attributes=dict(attributes),
+        )
+
+    def is_unique_resource_id(self, resource_id: str):
+        """
+        Returns whether the resource-id identifies exactly one node
+        """
+        return self.resource_id_count.get(resource_id, 0) == 1
+
+
+class SnapshotElement:
+    """
+    A ui element resolved from a snapshot which is acted on by resource-id or bounds
+    """
+
+    def __init__(self, driver, node: UiNode, snapshot: UiSnapshot):
+        self.driver = driver
+        self.node = node
+        self.unique_resource_id = snapshot.is_unique_resource_id(node.resource_id)
+
+    @property
+    def text(self):
+        """
+        Returns the text of the element at the time of the snapshot
+        """
+        return self.node.text
+
+    def get_attribute(self, name: str):
+        """
+        Returns an attribute of the element at the time of the snapshot
+        """
+        return self.node.attributes.get(name)
+
+    def click(self):
+        """
+        Clicks the element by tapping its bounds, which costs a single round trip.
+        Falls back to the resource-id if the node has no bounds.
+        """
+        if self.node.bounds is not None:
+            self.driver.tap([self.node.center()])
+        elif self.unique_resource_id:
+            self.driver.find_element(AppiumBy.ID, value=self.node.resource_id).click()
+        else:
+            raise ValueError(f"Node {self.node.class_name} can not be clicked")
@@ -0,0 +1,67 @@
+"""
+Module containing the explicit wait engine used for all ui lookups
+"""
+
+import os
+from time import monotonic, sleep
+from typing import Callable, Dict, Optional, TypeVar
+
+from pydantic import BaseModel
+from selenium.common.exceptions import WebDriverException
+
+T = TypeVar('T')
+
+
+class WaitConfig(BaseModel):
+    """
+    Dataclass for storing the timeouts used when waiting for ui elements
+    """
+    # Timeout for elements which have to appear for the flow to continue
+    timeout: float = float(os.environ.get('WAIT_TIMEOUT', 20))
+    # Timeout for elements which only appear sometimes like dialogs
+    optional_timeout: float = float(os.environ.get('WAIT_OPTIONAL_TIMEOUT', 2))
+    poll_interval: float = float(os.environ.get('WAIT_POLL_INTERVAL', 0.2))
+    # Timeouts overriding the defaults for single lookups, keyed by the target
+    step_timeouts: Dict[str, float] = {}
+
+    def timeout_for(self, target: str, optional: bool = False):
+        """
+        Returns the timeout to use when looking up the given target
+
+        Args:
+            target (str): The text or description looked up
+            optional (bool): Whether the element only appears sometimes
+
+        Returns:
+            float: The timeout in seconds
+        """
+        if target in self.step_timeouts:
+            return self.step_timeouts[target]
+        return self.optional_timeout if optional else self.timeout
+
+
+def wait_until(predicate: Callable[[], Optional[T]], timeout: float, poll_interval: float):
+    """
+    Evaluates the predicate until it returns a truthy value or the timeout expires.
+    WebDriver errors raised by the predicate count as no match.
+
+    Args:
+        predicate (Callable): The function to evaluate
+        timeout (float): The maximum number of seconds to wait
+        poll_interval (float): The number of seconds between two evaluations
+
+    Returns:
+        The value returned by the predicate or False if the timeout expired
+    """
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            if result := predicate():
+                return result
+        except WebDriverException:
+            pass
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        sleep(min(poll_interval, remaining))